@@ -0,0 +1,82 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+
+# Persistent cache of alignment results, stored in a SQLite database
+# Each entry is keyed by a hash of the petri net (plus initial/final markings) and of the ordered sequence of actual activities,
+# so identical week-departments across scenarios or across runs are aligned only once
+
+def open_cache(cache_path):
+  cache_dir = os.path.dirname(cache_path)
+  if cache_dir and not os.path.exists(cache_dir):
+    os.makedirs(cache_dir, exist_ok=True)
+
+  # the timeout lets worker processes wait for each other's writes instead of failing
+  conn = sqlite3.connect(cache_path, timeout=60)
+  conn.execute('PRAGMA journal_mode=WAL')
+  conn.execute('''
+    CREATE TABLE IF NOT EXISTS alignments (
+      key TEXT PRIMARY KEY,
+      result TEXT NOT NULL,
+      size INTEGER NOT NULL,
+      last_access REAL NOT NULL
+    )
+  ''')
+
+  return conn
+
+# Canonical hash of net, im, fm and trace
+# Places and transitions are identified by name (and label), arcs by the names of their endpoints,
+# everything is sorted so that the hash does not depend on set iteration order
+def compute_cache_key(net, im, fm, trace):
+  canonical = {
+    'places': sorted(place.name for place in net.places),
+    'transitions': sorted((transition.name, transition.label or '') for transition in net.transitions),
+    'arcs': sorted((arc.source.name, arc.target.name, arc.weight) for arc in net.arcs),
+    'im': sorted((place.name, tokens) for place, tokens in im.items()),
+    'fm': sorted((place.name, tokens) for place, tokens in fm.items()),
+    'trace': list(trace),
+  }
+
+  return hashlib.sha256(json.dumps(canonical).encode('utf-8')).hexdigest()
+
+def get_cached_alignment(conn, key):
+  row = conn.execute('SELECT result FROM alignments WHERE key = ?', (key,)).fetchone()
+
+  if row is None:
+    return None
+
+  with conn:
+    conn.execute('UPDATE alignments SET last_access = ? WHERE key = ?', (time.time(), key))
+
+  return json.loads(row[0])
+
+def put_cached_alignment(conn, key, alignment_res):
+  result = json.dumps(alignment_res)
+
+  with conn:
+    conn.execute(
+      'INSERT OR REPLACE INTO alignments (key, result, size, last_access) VALUES (?, ?, ?, ?)',
+      (key, result, len(result) + len(key), time.time())
+    )
+
+# Remove least recently used entries until the cache content fits in max_size bytes
+def evict_cache(conn, max_size):
+  total_size = conn.execute('SELECT COALESCE(SUM(size), 0) FROM alignments').fetchone()[0]
+  if total_size <= max_size:
+    return 0
+
+  evicted_keys = []
+  for key, size in conn.execute('SELECT key, size FROM alignments ORDER BY last_access').fetchall():
+    if total_size <= max_size:
+      break
+
+    evicted_keys.append((key,))
+    total_size -= size
+
+  with conn:
+    conn.executemany('DELETE FROM alignments WHERE key = ?', evicted_keys)
+
+  return len(evicted_keys)
@@ -1,61 +1,188 @@
 import os
-import matplotlib.pyplot as plt
 import json
+import numpy as np
+import pandas as pd
 from datetime import datetime
 
 from config import *
-
-# Calcolo fitness media per reparto
-def compute_average_fitness_by_department(
-  dataset,
+from results_store import read_results
+
+# Aggregation engine: results are kept in a DataFrame with one row per year_week_department, whose key is parsed once into
+# year, week, department (plus year_week and quarter) columns, and aggregated with a single groupby for any combination
+# of those columns (e.g. ['department'], ['year_week'], ['department', 'quarter'])
+
+FITNESS_PERCENTILES = [0.25, 0.5, 0.75]
+
+# Parse the distinct year_week_department keys into a DataFrame indexed by key
+# year_week is categorical, ordered by (year, week), so that groupbys on it are sorted chronologically
+def parse_year_week_departments(year_week_departments):
+  keys = pd.Index(pd.unique(np.asarray(year_week_departments, dtype=object)), name='year_week_department')
+  parts = keys.to_series().str.split('-', expand=True).reindex(columns=[0, 1, 2]).astype(str)
+
+  parsed = pd.DataFrame({
+    'year': parts[0].astype(int).to_numpy(),
+    'week': parts[1].astype(int).to_numpy(),
+    'department': parts[2].to_numpy(),
+    'year_week': (parts[0] + '-' + parts[1]).to_numpy(),
+  }, index=keys)
+
+  parsed['quarter'] = np.minimum((parsed['week'] - 1) // 13 + 1, 4)
+
+  year_weeks = parsed.drop_duplicates('year_week').sort_values(['year', 'week'], kind='stable')['year_week']
+  parsed['year_week'] = pd.Categorical(parsed['year_week'], categories=year_weeks, ordered=True)
+
+  return parsed
+
+# Results as a DataFrame with the fitness of each year_week_department (in the order of the results json) and its parsed key
+# from the results store if given (reading only the fitness columns), otherwise from results or from the results json
+# approximate is True for the weeks whose fitness is only an upper bound (their alignment exceeded its budget)
+def load_results(output_path, input_filename, results=None, results_store_path=None, scenario=None):
+  if results is None and results_store_path is not None:
+    fitness = read_results(results_store_path, scenario, columns=['year_week_department', 'average_trace_fitness', 'approximate'])
+    fitness = fitness.rename(columns={ 'average_trace_fitness': 'fitness' })
+  else:
+    if results is None:
+      with open(os.path.join(output_path, input_filename)) as f:
+        results = json.load(f)
+
+    fitness = pd.DataFrame({
+      'year_week_department': pd.Series(list(results.keys()), dtype=object),
+      'fitness': pd.Series([result['average_trace_fitness'] for result in results.values()], dtype=float),
+      'approximate': pd.Series([result.get('approximate', False) for result in results.values()], dtype=bool),
+    })
+
+  fitness['fitness'] = fitness['fitness'].astype(float)
+  fitness['approximate'] = fitness['approximate'].astype(bool)
+
+  parsed = parse_year_week_departments(fitness['year_week_department'])
+
+  return fitness.join(parsed, on='year_week_department')
+
+# Mean fitness, number of weeks with perfect fitness, number of weeks, number of weeks with an approximate fitness and
+# percentiles of the fitness of each group
+# fitness is the output of load_results, by one or more of its columns
+def aggregate_fitness(fitness, by, percentiles=FITNESS_PERCENTILES):
+  groups = fitness.groupby(by, sort=True, observed=True)
+  group_idxs = groups.ngroup().to_numpy()
+  n_groups = groups.ngroups
+
+  # bincount adds the values of each group in order, i.e. the same sums (to the last bit) as sum() over the group
+  fitness_sum = np.bincount(group_idxs, weights=fitness['fitness'].to_numpy(), minlength=n_groups)
+  weeks = np.bincount(group_idxs, minlength=n_groups)
+  perfect = np.bincount(group_idxs, weights=(fitness['fitness'] == 1.0).to_numpy(), minlength=n_groups).astype(int)
+  approximate = np.bincount(group_idxs, weights=fitness['approximate'].to_numpy(), minlength=n_groups).astype(int)
+
+  summary = pd.DataFrame({
+    'mean_fitness': fitness_sum / np.maximum(weeks, 1),
+    'perfect_fitness': perfect,
+    'weeks': weeks,
+    'approximate_fitness': approximate,
+  }, index=groups.size().index)
+
+  if len(percentiles) > 0 and n_groups > 0:
+    quantiles = groups['fitness'].quantile(percentiles).unstack()
+    for percentile in percentiles:
+      summary[f'p{int(percentile * 100)}_fitness'] = quantiles[percentile].to_numpy()
+
+  return summary
+
+# Summary of the fitness grouped by any columns of load_results (e.g. ['department', 'quarter']), optionally saved as csv
+def compute_fitness_summary(
+  by,
   output_path='output',
-  output_filename='average_fitness_by_department.json',
+  output_filename=None,
   input_filename='results.json',
+  results=None,
+  results_store_path=None,
+  scenario=None,
+  percentiles=FITNESS_PERCENTILES,
 ):
-  print('Computing average fitness by department...')
-  
-  with open(os.path.join(output_path, input_filename)) as f:
-    results = json.load(f)
+  summary = aggregate_fitness(load_results(output_path, input_filename, results, results_store_path, scenario), by, percentiles)
+
+  if output_filename is not None:
+    summary.to_csv(os.path.join(output_path, output_filename))
+
+  return summary
+
+# Average fitness of each group of the dataset keys (by a single column of parse_year_week_departments), printing a line
+# for each of them; in incremental runs only the groups of the changed results are averaged again, the others are taken
+# from the previous output
+def compute_average_fitness_by(
+  dataset,
+  by,
+  output_path,
+  output_filename,
+  input_filename,
+  results=None,
+  changed_year_week_departments=None,
+  results_store_path=None,
+  scenario=None,
+):
+  groups = parse_year_week_departments(dataset[YEAR_WEEK_DEPARTMENT_KEY].unique())[by].drop_duplicates().sort_values().tolist()
+
+  previous_avg_fitness = {}
+  groups_to_compute = groups
 
-  departments = dataset[YEAR_WEEK_DEPARTMENT_KEY].unique().tolist()
-  departments = [department.split('-')[2] for department in departments]
-  departments = list(set(departments))
-  departments = sorted(departments)
+  if changed_year_week_departments is not None and os.path.exists(os.path.join(output_path, output_filename)):
+    with open(os.path.join(output_path, output_filename)) as f:
+      previous_avg_fitness = json.load(f)
 
-  results_by_department = { department: [] for department in departments }
-  avg_fitness_by_department = {}
+    changed_groups = set(parse_year_week_departments(changed_year_week_departments)[by])
+    groups_to_compute = [group for group in groups if group in changed_groups or group not in previous_avg_fitness]
 
-  for k, v in results.items():
-    k_dep = k.split('-')[2]
-    results_by_department[k_dep].append(v['average_trace_fitness'])
+  fitness = load_results(output_path, input_filename, results, results_store_path, scenario)
+  summary = aggregate_fitness(fitness[fitness[by].isin(groups_to_compute)], by, percentiles=[])
 
-  for k, v in results_by_department.items():
-    if len(v) == 0:
-      avg_fitness = 0
-      print(f'{k}: no fitness computed.')
+  avg_fitness = {}
+
+  for group in groups_to_compute:
+    if group not in summary.index:
+      avg_fitness[group] = 0
+      print(f'{group}: no fitness computed.')
     else:
-      avg_fitness = sum(v) / len(v)
-      print(f'{k}: avg fitness {(avg_fitness*100):.1f}%, perfect fitness {v.count(1.0)}/{len(v)}')
+      mean_fitness, perfect_fitness, weeks, approximate_fitness = summary.loc[group, ['mean_fitness', 'perfect_fitness', 'weeks', 'approximate_fitness']]
+      avg_fitness[group] = float(mean_fitness)
 
-    avg_fitness_by_department[k] = avg_fitness
+      # weeks with an approximate fitness make the average an upper bound
+      approximate_note = f', approximate {int(approximate_fitness)}/{int(weeks)}' if approximate_fitness > 0 else ''
+      print(f'{group}: avg fitness {(mean_fitness*100):.1f}%, perfect fitness {int(perfect_fitness)}/{int(weeks)}{approximate_note}')
 
-  for department, avg_fitness_department in zip(departments, avg_fitness_by_department.keys()):
-    assert department == avg_fitness_department
+  avg_fitness = {
+    group: avg_fitness[group] if group in avg_fitness else previous_avg_fitness[group]
+    for group in groups
+  }
 
   with open(os.path.join(output_path, output_filename), 'w') as f:
-    json.dump(avg_fitness_by_department, f, indent=2)
+    json.dump(avg_fitness, f, indent=2)
+
+# Calcolo fitness media per reparto
+def compute_average_fitness_by_department(
+  dataset,
+  output_path='output',
+  output_filename='average_fitness_by_department.json',
+  input_filename='results.json',
+  results=None,
+  changed_year_week_departments=None,
+  results_store_path=None,
+  scenario=None,
+):
+  print('Computing average fitness by department...')
+
+  compute_average_fitness_by(
+    dataset, 'department', output_path, output_filename, input_filename,
+    results, changed_year_week_departments, results_store_path, scenario
+  )
 
-  
 def plot_average_fitness_by_department(
   dataset,
   output_path='output',
   output_filename='average_fitness_by_department.png',
   input_filenames=['average_fitness_by_department.json'],
 ):
-  departments = dataset[YEAR_WEEK_DEPARTMENT_KEY].unique().tolist()
-  departments = [department.split('-')[2] for department in departments]
-  departments = list(set(departments))
-  departments = sorted(departments)
+  # matplotlib is imported only when something is plotted, compute-only runs never load it
+  import matplotlib.pyplot as plt
+
+  departments = parse_year_week_departments(dataset[YEAR_WEEK_DEPARTMENT_KEY].unique())['department'].drop_duplicates().sort_values().tolist()
 
   plt.figure(figsize=(10, 6))
   colors = ['skyblue', 'lightgreen', 'lightcoral', 'lightsalmon', 'lightpink']
@@ -92,45 +219,17 @@ def compute_average_fitness_by_year_week(
   output_path='output',
   output_filename='average_fitness_by_year_week.json',
   input_filename='results.json',
+  results=None,
+  changed_year_week_departments=None,
+  results_store_path=None,
+  scenario=None,
 ):
   print('Computing average fitness by year_week...')
-  
-  with open(os.path.join(output_path, input_filename)) as f:
-    results = json.load(f)
-
-  year_weeks = dataset[YEAR_WEEK_DEPARTMENT_KEY].unique().tolist()
-  year_weeks = [year_week.split('-')[0] + '-' + year_week.split('-')[1] for year_week in year_weeks]
-  year_weeks = list(set(year_weeks))
-
-   # Custom sorting key
-  def sort_key(year_week):
-    year, week = year_week.split('-')
-    return (int(year), int(week))
-  
-  year_weeks = sorted(year_weeks, key=sort_key)
 
-  results_by_year_week = { year_week: [] for year_week in year_weeks }
-  avg_fitness_by_year_week = {}
-
-  for k, v in results.items():
-    k_year_week = k.split('-')[0] + '-' + k.split('-')[1]
-    results_by_year_week[k_year_week].append(v['average_trace_fitness'])
-
-  for k, v in results_by_year_week.items():
-    if len(v) == 0:
-      avg_fitness = 0
-      print(f'{k}: no fitness computed.')
-    else:
-      avg_fitness = sum(v) / len(v)
-      print(f'{k}: avg fitness {(avg_fitness*100):.1f}%, perfect fitness {v.count(1.0)}/{len(v)}')
-
-    avg_fitness_by_year_week[k] = avg_fitness
-
-  for year_week, avg_fitness_year_week in zip(year_weeks, avg_fitness_by_year_week.keys()):
-    assert year_week == avg_fitness_year_week
-
-  with open(os.path.join(output_path, output_filename), 'w') as f:
-    json.dump(avg_fitness_by_year_week, f, indent=2)
+  compute_average_fitness_by(
+    dataset, 'year_week', output_path, output_filename, input_filename,
+    results, changed_year_week_departments, results_store_path, scenario
+  )
 
 # Plot fitness media year_week
 def plot_average_fitness_by_year_week(
@@ -139,16 +238,10 @@ def plot_average_fitness_by_year_week(
   output_filename='average_fitness_by_year_week.png',
   input_filenames=['average_fitness_by_year_week.json'],
 ):
-  year_weeks = dataset[YEAR_WEEK_DEPARTMENT_KEY].unique().tolist()
-  year_weeks = [year_week.split('-')[0] + '-' + year_week.split('-')[1] for year_week in year_weeks]
-  year_weeks = list(set(year_weeks))
-
-  # Custom sorting key
-  def sort_key(year_week):
-    year, week = year_week.split('-')
-    return (int(year), int(week))
-  
-  year_weeks = sorted(year_weeks, key=sort_key)
+  # sorted by (year, week)
+  year_weeks = parse_year_week_departments(dataset[YEAR_WEEK_DEPARTMENT_KEY].unique())['year_week'].drop_duplicates().sort_values().tolist()
+
+  import matplotlib.pyplot as plt
 
   plt.figure(figsize=(10, 6))
   colors = ['skyblue', 'lightgreen', 'lightcoral', 'lightsalmon', 'lightpink']
@@ -158,10 +251,8 @@ def plot_average_fitness_by_year_week(
     with open(os.path.join(output_path, input_filename)) as f:
       avg_fitness_by_year_week = json.load(f)
   
-    # add possible missing year_weeks
-    for year_week in year_weeks:
-      if year_week not in avg_fitness_by_year_week:
-        avg_fitness_by_year_week[year_week] = 0
+    # add possible missing year_weeks (in the same order as year_weeks, e.g. for scenarios limited to a period)
+    avg_fitness_by_year_week = { year_week: avg_fitness_by_year_week.get(year_week, 0) for year_week in year_weeks }
 
     bars = plt.bar(year_weeks, avg_fitness_by_year_week.values(), color=colors[i % len(colors)], alpha=alpha, label=input_filename)
     
@@ -0,0 +1,280 @@
+import io
+import os
+import sys
+import json
+import time
+import tempfile
+import importlib
+import subprocess
+import multiprocessing
+import argparse
+import tracemalloc
+import contextlib
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+
+from config import *
+from generate_synthetic_dataset import generate_synthetic_dataset, save_synthetic_dataset
+from load_dataset import load_dataset
+from compute_alignment import cast_df, partition_dataset, build_petri_nets, run_alignment_jobs, get_alignment_worker_modules, warm_up_alignment_workers
+from occupancy import build_occupancy
+from compute_statistics import compute_room_usage, compute_usage_and_overtime, compute_room_idle_time, compute_concurrent_rooms
+from worker_pool import get_worker_context, PM4PY_WORKER_MODULES
+
+# Benchmark of the hot paths of the alignment and statistics pipelines on synthetic data at several scales
+# For each scale (departments x weeks) every stage reports its best wall time over --repeat runs, its throughput (units
+# per second, e.g. weeks aligned per second) and the peak memory it allocates (traced with tracemalloc in a separate
+# run, since tracing slows everything down). Results are printed and appended to output/benchmark/benchmark.jsonl, so
+# scaling curves can be compared across changes.
+# The startup benchmark measures the import time of each pipeline module in a fresh interpreter, against
+# STARTUP_IMPORT_BUDGET, and the time to start a pool of alignment workers with each start method (see worker_pool.py).
+
+DEFAULT_SCALES = ['4x13', '16x26', '32x52']
+
+STARTUP_MODULES = [
+  'run_pipeline_alignment', 'run_scenarios', 'compute_alignment', 'compute_statistics', 'analyze_alignment_results',
+  'period_analysis', 'deviation_index', 'petri_net_export',
+]
+
+# libraries that the pipeline modules import only when they are used
+LAZY_MODULES = ['pm4py', 'matplotlib', 'graphviz']
+
+# run in a fresh interpreter, prints (on its last line) the import time of module and the lazy libraries it loaded
+STARTUP_CODE = '''
+import sys, json, time
+start = time.perf_counter()
+import {module}
+import_time = time.perf_counter() - start
+print(json.dumps([import_time, [module for module in {lazy_modules} if module in sys.modules]]))
+'''
+
+# Run function(), returning its result and (best wall time in seconds, peak traced memory in MB)
+# Output of the stage (progress bars, skipped shifts, ...) is discarded
+def measure(function, repeat=1, should_trace_memory=True):
+  wall_time = None
+
+  with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+    for _ in range(repeat):
+      start = time.perf_counter()
+      result = function()
+      wall_time = min(wall_time or float('inf'), time.perf_counter() - start)
+
+    peak_memory_mb = None
+    if should_trace_memory:
+      tracemalloc.start()
+      function()
+      peak_memory_mb = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+      tracemalloc.stop()
+
+  return result, (wall_time, peak_memory_mb)
+
+def benchmark_scale(
+  n_departments,
+  n_weeks,
+  operations_per_day=4,
+  deviation_rate=0.2,
+  engines=['day_sequence'],
+  pm4py_max_weeks=50,
+  repeat=1,
+  should_trace_memory=True,
+  seed=0,
+):
+  rows = []
+
+  def add_row(stage_name, units, unit_name, measures):
+    wall_time, peak_memory_mb = measures
+    rows.append({
+      'departments': n_departments,
+      'weeks': n_weeks,
+      'stage': stage_name,
+      'units': units,
+      'unit': unit_name,
+      'wall_time': wall_time,
+      'throughput': units / wall_time if wall_time > 0 else None,
+      'peak_memory_mb': peak_memory_mb,
+    })
+
+  with tempfile.TemporaryDirectory() as data_path:
+    dataset, schedule = generate_synthetic_dataset(
+      n_departments=n_departments,
+      n_weeks=n_weeks,
+      operations_per_day=operations_per_day,
+      deviation_rate=deviation_rate,
+      seed=seed,
+    )
+    dataset_path, schedule_path = save_synthetic_dataset(dataset, schedule, data_path)
+
+    # alignment pipeline
+    dataset, measures = measure(lambda: load_dataset(dataset_path, use_snapshot=False), repeat, should_trace_memory)
+    add_row('load_dataset', len(dataset), 'rows', measures)
+
+    elective = dataset[dataset[URGENCY_TYPE_KEY].isin(['Elezione'])]
+    cast, measures = measure(lambda: cast_df(elective), repeat, should_trace_memory)
+    add_row('cast_df', len(cast), 'rows', measures)
+
+    partitions, measures = measure(lambda: partition_dataset(cast), repeat, should_trace_memory)
+    add_row('partition_dataset', len(partitions), 'weeks', measures)
+
+    year_week_departments = list(partitions)
+
+    # pm4py is imported lazily by the first net or alignment, its import time is measured by the startup benchmark
+    for module in PM4PY_WORKER_MODULES:
+      importlib.import_module(module)
+
+    petri_nets, measures = measure(lambda: build_petri_nets(partitions, year_week_departments, False), repeat, should_trace_memory)
+    add_row('build_petri_nets', len(petri_nets), 'weeks', measures)
+
+    for engine in engines:
+      # pm4py alignments are much slower, only a sample of the weeks is aligned
+      engine_year_week_departments = year_week_departments[:pm4py_max_weeks] if engine == 'pm4py' else year_week_departments
+
+      jobs = [
+        (year_week_department, *partitions[year_week_department], False, None, engine, petri_nets[year_week_department] if engine != 'day_sequence' else None)
+        for year_week_department in engine_year_week_departments
+      ]
+
+      _, measures = measure(lambda: run_alignment_jobs(jobs), repeat, should_trace_memory)
+      add_row(f'align_weeks ({engine})', len(jobs), 'weeks', measures)
+
+    # statistics pipeline
+    actual = dataset[dataset[SLICE_KEY] == SLICE_ACTUAL_VAL]
+
+    occupancy, measures = measure(lambda: build_occupancy(actual), repeat, should_trace_memory)
+    add_row('build_occupancy', len(actual), 'operations', measures)
+
+    _, measures = measure(lambda: compute_room_usage(occupancy), repeat, should_trace_memory)
+    add_row('compute_room_usage', len(actual), 'operations', measures)
+
+    _, measures = measure(lambda: compute_usage_and_overtime(occupancy, schedule_dataset_path=schedule_path), repeat, should_trace_memory)
+    add_row('compute_usage_and_overtime', len(actual), 'operations', measures)
+
+    _, measures = measure(lambda: compute_room_idle_time(occupancy), repeat, should_trace_memory)
+    add_row('compute_room_idle_time', len(actual), 'operations', measures)
+
+    _, measures = measure(lambda: compute_concurrent_rooms(occupancy), repeat, should_trace_memory)
+    add_row('compute_concurrent_rooms', len(actual), 'operations', measures)
+
+  return rows
+
+# Import time of module in a fresh interpreter (best of repeat, in seconds) and the lazy libraries it loaded
+def measure_import(module, repeat=1):
+  wall_time, loaded_modules = None, []
+
+  for _ in range(repeat):
+    output = subprocess.run(
+      [sys.executable, '-c', STARTUP_CODE.format(module=module, lazy_modules=LAZY_MODULES)],
+      cwd=os.path.dirname(os.path.abspath(__file__)),
+      capture_output=True,
+      text=True,
+      check=True,
+    ).stdout
+
+    import_time, loaded_modules = json.loads(output.splitlines()[-1])
+    wall_time = min(wall_time or float('inf'), import_time)
+
+  return wall_time, loaded_modules
+
+# Time to start a pool of n_workers alignment workers with start_method, until each of them has run an (empty) job
+# The first forkserver pool of a process also starts the server
+def measure_worker_startup(n_workers, start_method, engine='day_sequence'):
+  start = time.perf_counter()
+
+  with ProcessPoolExecutor(max_workers=n_workers, mp_context=get_worker_context(get_alignment_worker_modules(engine), start_method)) as executor:
+    warm_up_alignment_workers(executor, n_workers)
+
+  return time.perf_counter() - start
+
+def benchmark_startup(modules=STARTUP_MODULES, n_workers=4, repeat=1):
+  rows = []
+
+  def add_row(stage_name, units, unit_name, wall_time, **extra):
+    rows.append({
+      'departments': None,
+      'weeks': None,
+      'stage': stage_name,
+      'units': units,
+      'unit': unit_name,
+      'wall_time': wall_time,
+      'throughput': units / wall_time if wall_time > 0 else None,
+      'peak_memory_mb': None,
+      **extra,
+    })
+
+  for module in modules:
+    wall_time, loaded_modules = measure_import(module, repeat)
+    add_row(
+      f'import {module}', 1, 'imports', wall_time,
+      budget=STARTUP_IMPORT_BUDGET,
+      lazy_modules_loaded=loaded_modules,
+      within_budget=wall_time <= STARTUP_IMPORT_BUDGET and len(loaded_modules) == 0,
+    )
+
+  for start_method in multiprocessing.get_all_start_methods():
+    add_row(f'start workers ({start_method})', n_workers, 'workers', measure_worker_startup(n_workers, start_method))
+
+  return rows
+
+def print_benchmark(rows):
+  print(f'  {"scale":>8} {"stage":<36} {"units":>10} {"wall (s)":>10} {"units/s":>12} {"peak MB":>10}')
+
+  for row in rows:
+    scale = 'startup' if row['departments'] is None else f'{row["departments"]}x{row["weeks"]}'
+    throughput = f'{row["throughput"]:.1f}' if row['throughput'] is not None else '-'
+    peak_memory = f'{row["peak_memory_mb"]:.1f}' if row['peak_memory_mb'] is not None else '-'
+
+    print(f'  {scale:>8} {row["stage"]:<36} {row["units"]:>10} {row["wall_time"]:>10.3f} {throughput:>12} {peak_memory:>10}')
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Benchmark the alignment and statistics pipelines on synthetic data')
+  parser.add_argument('--scales', nargs='+', default=DEFAULT_SCALES, help='scales as <departments>x<weeks>')
+  parser.add_argument('--operations-per-day', type=int, default=4, help='maximum number of operations per room and day')
+  parser.add_argument('--deviation-rate', type=float, default=0.2, help='fraction of planned operations not performed or moved')
+  parser.add_argument('--engines', nargs='+', default=['day_sequence'], choices=['day_sequence', 'pm4py'], help='alignment engines to benchmark')
+  parser.add_argument('--pm4py-max-weeks', type=int, default=50, help='maximum number of weeks aligned with pm4py')
+  parser.add_argument('--repeat', type=int, default=1, help='number of timed runs of each stage (the best one is reported)')
+  parser.add_argument('--no-memory', action='store_true', help='skip the (slow) traced run that measures memory')
+  parser.add_argument('--startup-only', action='store_true', help='run only the startup benchmark (imports and worker pools)')
+  parser.add_argument('--workers', type=int, default=4, help='number of workers started by the startup benchmark')
+  parser.add_argument('--output', default=os.path.join(OUTPUT_PATH, 'benchmark'), help='folder where benchmark.jsonl is saved')
+  args = parser.parse_args(argv)
+
+  run = {
+    'timestamp': datetime.now().isoformat(timespec='seconds'),
+    'operations_per_day': args.operations_per_day,
+    'deviation_rate': args.deviation_rate,
+    'pandas': pd.__version__,
+  }
+
+  print('Benchmarking startup...')
+  rows = benchmark_startup(n_workers=args.workers, repeat=args.repeat)
+
+  for scale in [] if args.startup_only else args.scales:
+    n_departments, n_weeks = (int(value) for value in scale.split('x'))
+    print(f'Benchmarking {n_departments} departments x {n_weeks} weeks...')
+
+    rows += benchmark_scale(
+      n_departments,
+      n_weeks,
+      operations_per_day=args.operations_per_day,
+      deviation_rate=args.deviation_rate,
+      engines=args.engines,
+      pm4py_max_weeks=args.pm4py_max_weeks,
+      repeat=args.repeat,
+      should_trace_memory=not args.no_memory,
+    )
+
+  print_benchmark(rows)
+
+  for row in rows:
+    if not row.get('within_budget', True):
+      print(f'Over the startup budget: {row["stage"]} took {row["wall_time"]:.3f}s (budget {row["budget"]}s), loaded {row["lazy_modules_loaded"]}')
+
+  os.makedirs(args.output, exist_ok=True)
+  with open(os.path.join(args.output, 'benchmark.jsonl'), 'a') as f:
+    for row in rows:
+      f.write(json.dumps({ **run, **row }) + '\n')
+
+# The guard is needed because worker processes may re-import this module
+if __name__ == '__main__':
+  main()
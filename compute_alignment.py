@@ -1,173 +1,795 @@
 import os
-import pm4py
+import sys
+import numpy as np
 import pandas as pd
-from pm4py.objects.petri_net.obj import PetriNet, Marking
-from pm4py.objects.petri_net.utils import petri_utils
-from pm4py.conformance import fitness_alignments
-import importlib.util
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
 import json
+import hashlib
+from contextlib import ExitStack
+from collections import deque, defaultdict
+from itertools import islice
 
 from config import *
+from day_sequence_alignment import get_planned_days, is_day_sequence, day_sequence_fitness, get_day_sequence_moves, fitness_from_moves, add_model_moves, multiset_fitness_bound, estimate_state_space, MODEL_LOG_MOVE_COST, TAU_MOVE_COST
+from instrumentation import stage, capture_records, add_records
+from petri_net_export import petri_net_exporter, can_export_petri_nets
+from results_store import open_results_store, put_result, put_deviations, get_stored_results, set_stored_year_week_departments, delete_results
+from deviation_index import get_week_deviations
+from spill_dataset import load_partition
+from worker_pool import get_worker_context, import_modules, PM4PY_WORKER_MODULES
+from alignment_cache import open_cache, compute_cache_key, get_cached_alignment, put_cached_alignment, evict_cache
+
+# cache connections opened by this process (one per cache path), reused across weeks and by pool workers
+_cache_connections = {}
+
+def get_cache_connection(cache_path):
+  if cache_path not in _cache_connections:
+    _cache_connections[cache_path] = open_cache(cache_path)
+
+  return _cache_connections[cache_path]
 
 def cast_df(df):
   df = df.copy()
   
   df[ACTIVITY_KEY] = df[ACTIVITY_KEY].astype(str)
   df[TIMESTAMP_KEY] = pd.to_datetime(df[TIMESTAMP_KEY], format='%d/%m/%Y')
-  df = df.sort_values(by=TIMESTAMP_KEY)
+  df = df.sort_values(by=TIMESTAMP_KEY, kind='stable')
 
   return df
 
-def build_petri_net_for_week(prev, year_week_department, should_consider_reserves=True):
-  # ottieni operazioni solo per specifico anno, settimana e reparto
-  ops = prev[prev[YEAR_WEEK_DEPARTMENT_KEY] == year_week_department]
+# Split the (already cast) dataset into planned/actual operations of each year_week_department with a single groupby,
+# so that the alignment loop doesn't have to re-filter the whole dataset at every iteration
+def partition_dataset(dataset):
+  empty = dataset.iloc[0:0]
+  partitions = {}
+
+  for (slice_val, year_week_department), group in dataset.groupby([SLICE_KEY, YEAR_WEEK_DEPARTMENT_KEY], sort=False, observed=True):
+    if year_week_department not in partitions:
+      partitions[year_week_department] = { SLICE_PREV_VAL: empty, SLICE_ACTUAL_VAL: empty }
 
-  # conversioni necessarie per evitare errori
-  ops = cast_df(ops)
+    partitions[year_week_department][slice_val] = group
+
+  return {
+    year_week_department: (partition[SLICE_PREV_VAL], partition[SLICE_ACTUAL_VAL])
+    for year_week_department, partition in partitions.items()
+  }
+
+# Low-memory alternative to cast_df + partition_dataset (see LOW_MEMORY), on the operations of the given urgency types
+# Instead of filtering, casting and splitting copies of the whole dataset, the rows of each year_week_department are
+# located once by position (sorted by date, as cast_df does) and each week is materialized and cast only when needed
+# Returns (year_week_departments in order of appearance, get_partition(year_week_department) -> (prev, act) with the
+# same frames as partition_dataset)
+def index_week_partitions(dataset, urgency_types_to_consider):
+  # rows without a Year_Week_Reparto belong to no week, as with partition_dataset
+  rows = np.flatnonzero((dataset[URGENCY_TYPE_KEY].isin(urgency_types_to_consider) & dataset[YEAR_WEEK_DEPARTMENT_KEY].notna()).to_numpy())
+  keys = dataset[YEAR_WEEK_DEPARTMENT_KEY].iloc[rows]
 
-  # costruisci petri net delle operazioni preventivate per quello specifico reparto di quella specifica settimana
-  # il dataframe passato per fare discovery è in pratica una sola traccia (infatti il case_id è Year_Week_Reparto e c'è un solo valore per esso)
-  dates = ops[TIMESTAMP_KEY].unique()
+  year_week_department_list = keys.unique().tolist()
+  codes = pd.Categorical(keys, categories=year_week_department_list).codes
+  dates = pd.to_datetime(dataset[TIMESTAMP_KEY].iloc[rows], format='%d/%m/%Y').to_numpy()
+
+  # lexsort is stable: rows of the same week and day keep their order, as with the stable sort of cast_df
+  order = np.lexsort((dates, codes))
+  week_bounds = np.searchsorted(codes[order], np.arange(len(year_week_department_list) + 1))
+  rows = rows[order]
+
+  week_idxs = { year_week_department: week_idx for week_idx, year_week_department in enumerate(year_week_department_list) }
+
+  def get_partition(year_week_department):
+    week_idx = week_idxs[year_week_department]
+    week = dataset.iloc[rows[week_bounds[week_idx]:week_bounds[week_idx + 1]]]
+
+    return split_week(week)
+
+  return year_week_department_list, get_partition
+
+# (prev, act) of the rows of a single week, already sorted by date
+def split_week(week):
+  # only the operations of a week are cast, keys back to strings (a categorical case id would add empty cases to pm4py logs)
+  week = week.assign(**{
+    ACTIVITY_KEY: week[ACTIVITY_KEY].astype(str),
+    TIMESTAMP_KEY: pd.to_datetime(week[TIMESTAMP_KEY], format='%d/%m/%Y'),
+    YEAR_WEEK_DEPARTMENT_KEY: week[YEAR_WEEK_DEPARTMENT_KEY].astype(str),
+  })
+
+  slices = week[SLICE_KEY].to_numpy()
+  return week[slices == SLICE_PREV_VAL], week[slices == SLICE_ACTUAL_VAL]
+
+# Out-of-core alternative to index_week_partitions (see OUT_OF_CORE), on the week partitions spilled by spill_dataset
+# Returns the same (year_week_departments, get_partition), each week is read from its partition only when needed
+def index_spilled_week_partitions(partitions, urgency_types_to_consider):
+  urgency_types = [str(urgency_type) for urgency_type in urgency_types_to_consider]
+
+  # a week appears in the filtered dataset at its first row of one of the urgency types
+  first_rows = {}
+  for year_week_department, week_first_rows in zip(partitions['keys'], partitions['first_rows']):
+    rows = [row for urgency_type, row in week_first_rows.items() if urgency_type in urgency_types]
+    if len(rows) > 0:
+      first_rows[year_week_department] = min(rows)
+
+  year_week_department_list = sorted(first_rows, key=first_rows.__getitem__)
+
+  partition_idxs = { year_week_department: partition_idx for partition_idx, year_week_department in enumerate(partitions['keys']) }
+
+  def get_partition(year_week_department):
+    week = load_partition(partitions, partition_idxs[year_week_department])
+    week = week[week[URGENCY_TYPE_KEY].isin(urgency_types_to_consider)]
+
+    # rows of the same day keep their order, as with the stable sort of cast_df
+    return split_week(week.sort_values(by=TIMESTAMP_KEY, kind='stable'))
+
+  return year_week_department_list, get_partition
+
+# Fingerprint of the rows of a year_week_department that affect its alignment, stored with its results so that
+# incremental runs can detect changed weeks
+def compute_week_fingerprint(prev, act, should_consider_reserves=True):
+  fingerprint = hashlib.sha256(str(should_consider_reserves).encode('utf-8'))
+  fingerprint.update(pd.util.hash_pandas_object(prev[[ACTIVITY_KEY, TIMESTAMP_KEY, RESERVE_KEY]], index=False).values.tobytes())
+  fingerprint.update(b'|')
+  fingerprint.update(pd.util.hash_pandas_object(act[[ACTIVITY_KEY, TIMESTAMP_KEY]], index=False).values.tobytes())
+
+  return fingerprint.hexdigest()
+
+# Canonical form of the alignment of a week modulo its year_week_department label and dates, as a hash: the planned
+# activities of each day (in day order, each day as a sorted multiset, with reserve flags if reserves are considered)
+# and the actual activity sequence. Weeks with the same variant have the same net up to the names of places and
+# transitions, so they have the same alignment result and are aligned only once
+def compute_week_variant(prev, act, should_consider_reserves=True):
+  _, day_ends, activities, reserves = get_week_arrays(prev)
+
+  if not should_consider_reserves:
+    reserves = [False] * len(reserves)
+
+  days = tuple(
+    tuple(sorted(zip(activities[day_start:day_end], reserves[day_start:day_end])))
+    for day_start, day_end in zip([0] + day_ends[:-1], day_ends)
+  )
+
+  return hashlib.sha256(repr((should_consider_reserves, days, act[ACTIVITY_KEY].tolist())).encode('utf-8')).hexdigest()
+
+# Planned operations of a week as plain arrays grouped by day, used to build its petri net without touching the DataFrame:
+# (day labels, end index of each day, activities, reserve flags), activities and flags are in the order of ops
+# ops must contain only the (already cast) planned operations of a single year_week_department, see partition_dataset
+def get_week_arrays(ops):
+  dates = ops[TIMESTAMP_KEY].to_numpy()
+
+  # same labels used in the place names by the original per-row builder
+  day_labels = [f'{date}' for date in ops[TIMESTAMP_KEY].unique()]
+
+  # ops are sorted by date, so the operations of each day are contiguous
+  day_ends = np.append(np.flatnonzero(dates[1:] != dates[:-1]) + 1, len(dates))
+
+  activities = [sys.intern(activity) for activity in ops[ACTIVITY_KEY].tolist()]
+  reserves = (ops[RESERVE_KEY].to_numpy() == 1).tolist()
 
-  net = PetriNet(year_week_department)
+  return day_labels, day_ends.tolist(), activities, reserves
+
+# Arc is PetriNet.Arc, passed by build_petri_net_from_arrays so that pm4py is imported once per net
+def _add_arc(source, target, net, Arc):
+  arc = Arc(source, target)
+  net.arcs.add(arc)
+  source.out_arcs.add(arc)
+  target.in_arcs.add(arc)
 
-  if len(dates) == 0:
+# Build the petri net of a week from get_week_arrays in a single pass over its operations
+# The net is the same as the one built by build_petri_net_for_week (same places, transitions, labels and arcs)
+def build_petri_net_from_arrays(year_week_department, week_arrays, should_consider_reserves=True):
+  # pm4py is imported only by the functions that need it (nets and A* alignments), so that importing this module (e.g.
+  # in the workers of the day_sequence engine, which needs neither) doesn't load it
+  from pm4py.objects.petri_net.obj import PetriNet, Marking
+  Arc, Place, Transition = PetriNet.Arc, PetriNet.Place, PetriNet.Transition
+
+  day_labels, day_ends, activities, reserves = week_arrays
+
+  if len(day_labels) == 0:
     return None, None, None
 
-  # sources conterrà i places di partenza (in cui verranno messi i token iniziali)
-  sources = []
+  net = PetriNet(year_week_department)
+  places, transitions = net.places, net.transitions
 
-  # al tempo t, current_reserves conterrà le operazioni che posso essere eseguite sia a t che a t+1
+  im = Marking()
   current_reserves = []
-
   prev_day_t = None
+  day_start = 0
 
-  # per ogni giorno
-  for day_idx, date in enumerate(dates):
-    ops_date = ops[ops[TIMESTAMP_KEY] == date] # operazioni di quello specifico giorno
-
-    next_day_t = PetriNet.Transition(f'day-{day_idx}')
-    net.transitions.add(next_day_t)
+  for day_idx, (day_label, day_end) in enumerate(zip(day_labels, day_ends)):
+    next_day_t = Transition(f'day-{day_idx}')
+    transitions.add(next_day_t)
 
     if should_consider_reserves:
       for reserve in current_reserves:
-        petri_utils.add_arc_from_to(reserve, next_day_t, net)
+        _add_arc(reserve, next_day_t, net, Arc)
       current_reserves = []
 
-    # per ogni operazione di quel giorno
-    for _, op_date in ops_date.iterrows():
-      is_reserve = op_date[RESERVE_KEY] == 1
-
-      p1 = PetriNet.Place(f'{date}-{op_date[ACTIVITY_KEY]}-1')
-      p2 = PetriNet.Place(f'{date}-{op_date[ACTIVITY_KEY]}-2')
-
-      if day_idx == 0:
-        sources.append(p1)
+    for activity, is_reserve in zip(activities[day_start:day_end], reserves[day_start:day_end]):
+      p1 = Place(f'{day_label}-{activity}-1')
+      p2 = Place(f'{day_label}-{activity}-2')
+      t = Transition(activity, activity)
 
-      t = PetriNet.Transition(op_date[ACTIVITY_KEY], op_date[ACTIVITY_KEY])
+      places.add(p1)
+      places.add(p2)
+      transitions.add(t)
 
-      net.places.add(p1)
-      net.places.add(p2)
-      net.transitions.add(t)
-
-      if prev_day_t:
-        petri_utils.add_arc_from_to(prev_day_t, p1, net)  
+      if prev_day_t is None:
+        im[p1] = 1
+      else:
+        _add_arc(prev_day_t, p1, net, Arc)
 
-      petri_utils.add_arc_from_to(p1, t, net)
-      petri_utils.add_arc_from_to(t, p2, net)
+      _add_arc(p1, t, net, Arc)
+      _add_arc(t, p2, net, Arc)
 
+      # reserves can be performed also on the next day, so they are linked to the next day-i transition
       if should_consider_reserves and is_reserve:
-        current_reserves.append(p2) # p2 must be linked to next_day_t on next iteration
+        current_reserves.append(p2)
       else:
-        petri_utils.add_arc_from_to(p2, next_day_t, net)
+        _add_arc(p2, next_day_t, net, Arc)
 
     prev_day_t = next_day_t
+    day_start = day_end
 
-  sink = PetriNet.Place('sink')
-  net.places.add(sink)
-  petri_utils.add_arc_from_to(prev_day_t, sink, net)
+  sink = Place('sink')
+  places.add(sink)
+  _add_arc(prev_day_t, sink, net, Arc)
 
-  if should_consider_reserves:
-    # if some reserves are left, link them to sink
-    for reserve in current_reserves:
-      petri_utils.add_arc_from_to(reserve, next_day_t, net)
-    current_reserves = []
-
-  # inserisci token iniziali
-  im = Marking()
-  for source in sources:
-    im[source] = 1
+  # reserves of the last day are linked to the last day-i transition
+  for reserve in current_reserves:
+    _add_arc(reserve, prev_day_t, net, Arc)
 
   fm = Marking()
   fm[sink] = 1
 
   return net, im, fm
 
+# costruisci petri net delle operazioni preventivate per quello specifico reparto di quella specifica settimana
+# ops must contain only the (already cast) planned operations of year_week_department, see partition_dataset
+def build_petri_net_for_week(ops, year_week_department, should_consider_reserves=True):
+  return build_petri_net_from_arrays(year_week_department, get_week_arrays(ops), should_consider_reserves)
+
+# Build the petri nets of all the given weeks up front, as { year_week_department: (net, im, fm) }
+# partitions is the output of partition_dataset (only the planned operations are used)
+def build_petri_nets(partitions, year_week_departments, should_consider_reserves=True):
+  return {
+    year_week_department: build_petri_net_from_arrays(
+      year_week_department,
+      get_week_arrays(partitions[year_week_department][0]),
+      should_consider_reserves
+    )
+    for year_week_department in year_week_departments
+  }
+
+# Cost of aligning the empty trace with the net of a week (the best worst cost of pm4py alignments): every complete run
+# of the nets built by build_petri_net_from_arrays fires each transition exactly once, each one as a move on model
+def get_best_worst_cost(net):
+  num_visible = sum(1 for transition in net.transitions if transition.label is not None)
+
+  return num_visible * MODEL_LOG_MOVE_COST + (len(net.transitions) - num_visible) * TAU_MOVE_COST
+
+# Alignment of a trace (list of activities) with the net of a week, running the A* variant of pm4py directly on a Trace
+# built from the list: no DataFrame is validated and converted into an event log at each call, and the best worst cost
+# isn't computed with another A* search (see get_best_worst_cost)
+# Returns the pm4py alignment (with its fitness and bwc), None if the search took more than max_time seconds
+def align_trace(trace, net, im, fm, max_time=None):
+  from pm4py.objects.log.obj import Trace, Event
+  from pm4py.algo.conformance.alignments.petri_net import algorithm as alignments
+
+  parameters = {
+    alignments.Parameters.ACTIVITY_KEY: ACTIVITY_KEY,
+    alignments.Parameters.BEST_WORST_COST_INTERNAL: get_best_worst_cost(net),
+  }
+  if max_time is not None:
+    parameters[alignments.Parameters.PARAM_MAX_ALIGN_TIME_TRACE] = max_time
+
+  return alignments.apply_trace(Trace([Event({ ACTIVITY_KEY: activity }) for activity in trace]), net, im, fm, parameters=parameters)
+
+# Alignment-based fitness of the trace of a week, same as pm4py.conformance.fitness_alignments on its actual operations
+# Returns None if the A* search took more than max_time seconds (None = unbounded)
+def align_trace_fitness(trace, net, im, fm, max_time=None):
+  from pm4py.algo.evaluation.replay_fitness.variants.alignment_based import evaluate as evaluate_alignments
+
+  # pm4py sees no case at all in a week without actual operations
+  if len(trace) == 0:
+    return evaluate_alignments([])
+
+  aligned_trace = align_trace(trace, net, im, fm, max_time=max_time)
+  if aligned_trace is None:
+    return None
+
+  return evaluate_alignments([aligned_trace])
+
+# Moves (see get_day_sequence_moves) of a pm4py alignment of a trace with the net of a week, whose planned days are days
+# Transitions are labelled with their activity only, so a synchronous move is assigned to the first day its activity is
+# planned on that has no synchronous move yet
+def get_alignment_moves(days, alignment):
+  from pm4py.objects.petri_net.utils.align_utils import SKIP
+
+  planned_day_idxs = defaultdict(deque)
+  for day_idx, (planned, reserves) in enumerate(days):
+    for activity, count in (planned + reserves).items():
+      planned_day_idxs[activity].extend([day_idx] * count)
+
+  moves = []
+  event_idx = 0
+
+  for log_label, model_label in alignment:
+    # moves on model (and the silent day-i transitions) are added by add_model_moves
+    if log_label == SKIP:
+      continue
+
+    if model_label == SKIP:
+      moves.append(('log', log_label, None, event_idx))
+    else:
+      moves.append(('sync', log_label, planned_day_idxs[log_label].popleft(), event_idx))
+
+    event_idx += 1
+
+  return add_model_moves(days, moves)
+
+# Same as align_trace_fitness, also returning the moves of the alignment (see get_alignment_moves), (None, None) if the
+# A* search took more than max_time seconds
+def align_trace_fitness_and_moves(trace, days, net, im, fm, max_time=None):
+  from pm4py.algo.evaluation.replay_fitness.variants.alignment_based import evaluate as evaluate_alignments
+
+  if len(trace) == 0:
+    return evaluate_alignments([]), get_alignment_moves(days, [])
+
+  aligned_trace = align_trace(trace, net, im, fm, max_time=max_time)
+  if aligned_trace is None:
+    return None, None
+
+  return evaluate_alignments([aligned_trace]), get_alignment_moves(days, aligned_trace['alignment'])
+
+# Build the petri net of a single year_week_department and align its actual operations to it
+# Returns (alignment result, whether it was found in the cache or None if the cache wasn't used, moves of the alignment);
+# the result is None if the week has no planned operations (i.e. it must be skipped)
+# engine can be 'pm4py' (A* alignments), 'day_sequence' (see day_sequence_alignment.py) or 'cross_check' (both, checking they agree)
+# weeks that the day_sequence engine can't handle are always aligned with pm4py
+# petri_net is the (net, im, fm) of the week if it was already built (see build_petri_nets), None to build it here
+# A* alignments are bounded by max_time (seconds) and max_states (see estimate_state_space), None = unbounded: weeks that
+# exceed a budget get the cheap upper bound of multiset_fitness_bound instead, flagged with 'approximate': True
+# The moves of the alignment (see get_day_sequence_moves) are returned only if should_index_deviations, and never for
+# skipped weeks and approximate results
+def align_week(
+  year_week_department,
+  prev,
+  act,
+  should_consider_reserves=True,
+  cache_path=None,
+  engine='pm4py',
+  petri_net=None,
+  max_time=None,
+  max_states=None,
+  should_index_deviations=False,
+):
+  trace = act[ACTIVITY_KEY].tolist()
+
+  days = None
+  if engine != 'pm4py' or max_time is not None or max_states is not None or should_index_deviations:
+    days = get_planned_days(prev, should_consider_reserves)
+
+  # the day_sequence engine doesn't need the petri net
+  if engine == 'day_sequence' and is_day_sequence(days):
+    if len(days) == 0:
+      return None, None, None
+
+    with stage('day_sequence_fitness', year_week_department):
+      if should_index_deviations:
+        moves = get_day_sequence_moves(days, trace)
+        return fitness_from_moves(days, trace, moves), None, moves
+
+      return day_sequence_fitness(days, trace), None, None
+
+  # costruisci la petri net
+  if petri_net is None:
+    with stage('build_petri_net_for_week', year_week_department):
+      petri_net = build_petri_net_for_week(
+        prev,
+        year_week_department,
+        should_consider_reserves=should_consider_reserves
+      )
+
+  net, im, fm = petri_net
+
+  if net == None:
+    return None, None, None
+
+  # generate traces from petrinet
+  # log = pm4py.play_out(net, im, fm)
+  # pm4py.write_xes(log, f'{year_week_department}.xes')
+
+  alignment_res, cache_hit, moves = None, None, None
+
+  if cache_path is not None:
+    cache = get_cache_connection(cache_path)
+    cache_key = compute_cache_key(net, im, fm, trace)
+
+    alignment_res = get_cached_alignment(cache, cache_key)
+
+    # entries cached without their moves are aligned again when the moves are needed
+    if alignment_res is not None:
+      moves = alignment_res.pop('moves', None)
+
+      if not should_index_deviations:
+        moves = None
+      elif moves is None:
+        alignment_res = None
+      else:
+        moves = [tuple(move) for move in moves]
+
+    cache_hit = alignment_res is not None
+
+  if alignment_res is None:
+    # conformance checking
+    if max_states is None or estimate_state_space(days, trace) <= max_states:
+      with stage('align_trace_fitness', year_week_department):
+        if should_index_deviations:
+          alignment_res, moves = align_trace_fitness_and_moves(trace, days, net, im, fm, max_time=max_time)
+        else:
+          alignment_res = align_trace_fitness(trace, net, im, fm, max_time=max_time)
+
+    if alignment_res is None:
+      with stage('multiset_fitness_bound', year_week_department):
+        alignment_res = { **multiset_fitness_bound(days, trace), 'approximate': True }
+
+    # approximate results aren't cached, so that they are computed again with a larger budget
+    elif cache_path is not None:
+      put_cached_alignment(cache, cache_key, alignment_res if moves is None else { **alignment_res, 'moves': moves })
+
+  if engine == 'cross_check' and is_day_sequence(days) and not alignment_res.get('approximate', False):
+    day_sequence_res = day_sequence_fitness(days, trace)
+    assert day_sequence_res == alignment_res, f'{year_week_department}: day_sequence fitness {day_sequence_res} differs from pm4py fitness {alignment_res}'
+
+  return alignment_res, cache_hit, moves
+
+# executor.map passes a single argument, so unpack the job tuple here (must be a module-level function to be picklable)
+# The instrumentation records are returned with the result, since workers can't add them to the ones of the main process
+def _align_week_job(job):
+  year_week_department, prev, act = job[:3]
+
+  with capture_records() as records:
+    with stage('align_week', year_week_department, planned=len(prev), actual=len(act)):
+      alignment_res, cache_hit, moves = align_week(*job)
+
+  return alignment_res, cache_hit, moves, records
+
+# a chunk of jobs, sent to a worker at once
+def _align_week_jobs(jobs):
+  return [_align_week_job(job) for job in jobs]
+
+# Start the workers of an alignment pool (see run_alignment_jobs) by sending each of them an empty chunk of jobs, returns
+# once all of them are done
+def warm_up_alignment_workers(executor, n_workers):
+  list(executor.map(_align_week_jobs, [[]] * n_workers))
+
+# Modules preloaded by the alignment workers (see get_worker_context) for the given engine: the workers of the
+# day_sequence engine import pm4py only if they get a week that engine can't handle
+def get_alignment_worker_modules(engine='pm4py'):
+  if engine == 'day_sequence':
+    return ['compute_alignment']
+
+  return ['compute_alignment', *PM4PY_WORKER_MODULES]
+
+# Run the alignment jobs (tuples of align_week arguments), returning the results of _align_week_job in the same order
+# Each year_week_department is independent from the others, so with n_workers > 1 they are spread over a process pool,
+# in chunks of chunk_size jobs; results are collected in the same order as jobs, so the output is identical to a serial run
+# jobs can be a generator (total is then the number of jobs, for the progress bar): it is consumed only as workers free
+# up, at most 2 chunks per worker ahead, so that the weeks waiting to be aligned don't pile up in memory
+# on_result(job_idx, result) is called as soon as the result of each job is available
+# Workers start with the modules of get_alignment_worker_modules(engine) already imported (serial runs import them first)
+def run_alignment_jobs(jobs, n_workers=1, chunk_size=1, on_result=None, total=None, engine='pm4py'):
+  if total is None:
+    total = len(jobs)
+
+  with ExitStack() as exit_stack:
+    if n_workers > 1:
+      executor = exit_stack.enter_context(ProcessPoolExecutor(
+        max_workers=n_workers,
+        mp_context=get_worker_context(get_alignment_worker_modules(engine)),
+      ))
+      alignment_results_iter = _map_bounded(executor, _align_week_jobs, jobs, chunk_size, 2 * n_workers)
+    else:
+      # imported in their own stage, as the workers preload them, so that the first week aligned doesn't pay for them
+      with stage('import_alignment_modules'):
+        import_modules(get_alignment_worker_modules(engine))
+
+      alignment_results_iter = map(_align_week_job, jobs)
+
+    alignment_results = []
+    for alignment_result in tqdm(alignment_results_iter, total=total):
+      if on_result is not None:
+        on_result(len(alignment_results), alignment_result)
+
+      alignment_results.append(alignment_result)
+
+  return alignment_results
+
+# Like executor.map(function, chunks of jobs), but with at most max_pending chunks submitted and not yet collected
+def _map_bounded(executor, function, jobs, chunk_size, max_pending):
+  jobs = iter(jobs)
+  pending = deque()
+
+  for chunk in iter(lambda: list(islice(jobs, chunk_size)), []):
+    pending.append(executor.submit(function, chunk))
+
+    if len(pending) >= max_pending:
+      yield from pending.popleft().result()
+
+  while len(pending) > 0:
+    yield from pending.popleft().result()
+
+# Alignment plan shared by compute_alignment and run_scenarios: the weeks to align, of one or more scenarios, grouped by
+# variant (see compute_week_variant), so that only the first week of each variant is aligned and its result is used for
+# all the weeks of the variant (in any scenario)
+# job_weeks has, for each job, the (scenario, year_week_department, position in the results of the scenario, fingerprint)
+# of the weeks it aligns, the first one being the week the job aligns
+def new_alignment_plan():
+  return { 'job_weeks': [], 'variant_job_idxs': {} }
+
+# Add a week to the plan (week as in job_weeks, prev and act its operations), returns the index of its job, or None if
+# its stored result (see get_stored_results) can be reused instead: its rows didn't change since it was stored and its
+# fitness isn't approximate (approximate results are stale, they are aligned again as the cache does, see align_week)
+def plan_week(plan, week, prev, act, should_consider_reserves=True, stored_result=None):
+  fingerprint = week[3]
+
+  if stored_result is not None and stored_result[0] == fingerprint and not stored_result[2]:
+    return None
+
+  variant = compute_week_variant(prev, act, should_consider_reserves)
+  if variant not in plan['variant_job_idxs']:
+    plan['variant_job_idxs'][variant] = len(plan['job_weeks'])
+    plan['job_weeks'].append([])
+
+  job_idx = plan['variant_job_idxs'][variant]
+  plan['job_weeks'][job_idx].append(week)
+
+  return job_idx
+
+# Store the result of a job (see run_alignment_jobs) for each of its weeks: its result row and, if
+# should_index_deviations, its moves dated with the operations of each week, get_week_partition(week) -> (prev, act)
+def store_job_result(results_store, weeks, alignment_result, should_index_deviations=False, get_week_partition=None):
+  for week in weeks:
+    scenario, year_week_department, position, fingerprint = week
+
+    if results_store is not None:
+      put_result(results_store, scenario, year_week_department, position, fingerprint, alignment_result[0])
+
+    # moves are dated with the operations of each week of the variant
+    if should_index_deviations:
+      moves = alignment_result[2]
+      put_deviations(
+        results_store, scenario, year_week_department,
+        [] if moves is None else get_week_deviations(moves, *get_week_partition(week))
+      )
+
+# Add the instrumentation records of the results of the planned jobs, print how many weeks got an approximate fitness
+# and the cache hits and misses, and evict the cache down to cache_max_size bytes
+def report_alignment_results(alignment_results, job_weeks, cache_path=None, cache_max_size=None):
+  cache_hits, cache_misses, approximate = 0, 0, 0
+
+  for (alignment_res, cache_hit, _, records), weeks in zip(alignment_results, job_weeks):
+    add_records(records)
+
+    if alignment_res != None and alignment_res.get('approximate', False):
+      approximate += len(weeks)
+
+    if cache_hit == True:
+      cache_hits += 1
+    elif cache_hit == False:
+      cache_misses += 1
+
+  if approximate > 0:
+    print(f'Alignment budget exceeded: {approximate}/{sum(len(weeks) for weeks in job_weeks)} weeks have an approximate fitness (multiset upper bound)')
+
+  if cache_hits + cache_misses > 0:
+    print(f'Alignment cache: {cache_hits} hits, {cache_misses} misses')
+
+    if cache_max_size is not None:
+      evicted = evict_cache(get_cache_connection(cache_path), cache_max_size)
+      if evicted > 0:
+        print(f'Alignment cache: evicted {evicted} entries')
+
 def compute_alignment(
   dataset,
   output_path='output',
   output_filename='results.json',
   urgency_types_to_consider=['Elezione'],
   should_consider_reserves=True,
-  should_save_petri_nets=False
+  should_save_petri_nets=False,
+  petri_nets_format='svg',
+  petri_nets_store_path=PETRI_NETS_STORE_PATH,
+  n_workers=1,
+  chunk_size=1,
+  cache_path=None,
+  cache_max_size=None,
+  engine='pm4py',
+  incremental=False,
+  petri_nets=None,
+  results_store_path=None,
+  scenario=None,
+  max_time=None,
+  max_states=None,
+  low_memory=False,
+  should_index_deviations=False,
+  week_partitions=None,
 ):
   print('Computing alignments...')
-  
-  # keep only specified types of operations
-  dataset = dataset[dataset[URGENCY_TYPE_KEY].isin(urgency_types_to_consider)]
 
-  year_week_department_list = dataset[YEAR_WEEK_DEPARTMENT_KEY].unique().tolist()
   results = {}
   skipped = []
 
-  for year_week_department in tqdm(year_week_department_list):
-    # separa operazioni preventivate da effettuate
-    prev, act = dataset[dataset[SLICE_KEY] == SLICE_PREV_VAL], dataset[dataset[SLICE_KEY] == SLICE_ACTUAL_VAL]
+  # in out-of-core mode (week_partitions is the manifest of the week partitions of spill_dataset, dataset is not used)
+  # the weeks are read from disk one at a time, as in low-memory mode
+  if week_partitions is not None:
+    low_memory = True
 
-    # costruisci la petri net
-    net, im, fm = build_petri_net_for_week(
-      prev,
-      year_week_department,
-      should_consider_reserves=should_consider_reserves
-    )
+    with stage('index_week_partitions'):
+      year_week_department_list, get_partition = index_spilled_week_partitions(week_partitions, urgency_types_to_consider)
+  # in low-memory mode the weeks are materialized one at a time, see index_week_partitions
+  elif low_memory:
+    with stage('index_week_partitions'):
+      year_week_department_list, get_partition = index_week_partitions(dataset, urgency_types_to_consider)
+  else:
+    # keep only specified types of operations
+    dataset = dataset[dataset[URGENCY_TYPE_KEY].isin(urgency_types_to_consider)]
 
-    if net == None:
-      skipped.append(year_week_department)
-      continue
+    # rows without a Year_Week_Reparto belong to no week (partition_dataset leaves them out)
+    year_week_department_list = dataset[YEAR_WEEK_DEPARTMENT_KEY].dropna().unique().tolist()
 
-    if should_save_petri_nets:
-      petri_nets_path = os.path.join(output_path, 'petri_nets')
-      if importlib.util.find_spec('graphviz'):
-        if not os.path.exists(petri_nets_path):
-          os.makedirs(petri_nets_path)
-        
-        pm4py.save_vis_petri_net(net, im, fm, os.path.join(petri_nets_path, f'{year_week_department}-{should_consider_reserves}.svg'))
+    # conversioni necessarie per evitare errori (una sola volta su tutto il dataset)
+    with stage('cast_df'):
+      dataset = cast_df(dataset)
 
-      # generate traces from petrinet
-      # log = pm4py.play_out(net, im, fm)
-      # pm4py.write_xes(log, f'{year_week_department}.xes')
+    # separa operazioni preventivate da effettuate, per ogni year_week_department
+    with stage('partition_dataset'):
+      partitions = partition_dataset(dataset)
 
-    # filtra per year_week_department
-    act = act[act[YEAR_WEEK_DEPARTMENT_KEY] == year_week_department]
+    get_partition = partitions.__getitem__
 
-    # conversioni necessarie per evitare errori
-    act = cast_df(act)
+  petri_nets_path = None
+  if should_save_petri_nets and can_export_petri_nets(petri_nets_format):
+    petri_nets_path = os.path.join(output_path, 'petri_nets')
+    if not os.path.exists(petri_nets_path):
+      os.makedirs(petri_nets_path)
 
-    # conformance checking
-    alignment_res = fitness_alignments(
-      act,
-      net,
-      im,
-      fm,
-      multi_processing=False,
-      activity_key=ACTIVITY_KEY,
-      case_id_key=YEAR_WEEK_DEPARTMENT_KEY,
-      timestamp_key=TIMESTAMP_KEY,
+  # results are streamed to the results store (if any) as soon as each week is aligned, as rows of scenario
+  # in incremental mode, weeks already in the store whose rows didn't change (same fingerprint) reuse the stored results,
+  # unless their fitness is approximate, so an incremental run also resumes an interrupted one
+  assert not incremental or results_store_path is not None, 'incremental runs need a results store'
+
+  if scenario is None:
+    scenario = os.path.splitext(output_filename)[0]
+
+  results_store, stored_results = None, {}
+
+  if results_store_path is not None:
+    results_store = open_results_store(results_store_path)
+
+    if incremental:
+      stored_results = get_stored_results(results_store, scenario)
+    else:
+      delete_results(results_store, scenario)
+
+  # the moves of the alignments are indexed in the results store (see deviation_index.py)
+  should_index_deviations = should_index_deviations and results_store is not None
+
+  # weeks to align (the ones not stored or whose rows changed since they were stored), grouped by variant
+  # fingerprints are computed only if the results are stored
+  year_week_departments_to_align = []
+  plan = new_alignment_plan()
+
+  with stage('plan_alignments'):
+    for position, year_week_department in enumerate(year_week_department_list):
+      prev, act = get_partition(year_week_department)
+
+      fingerprint = None
+      if results_store is not None:
+        fingerprint = compute_week_fingerprint(prev, act, should_consider_reserves)
+
+      week = (scenario, year_week_department, position, fingerprint)
+      if plan_week(plan, week, prev, act, should_consider_reserves, stored_results.get(year_week_department)) is not None:
+        year_week_departments_to_align.append(year_week_department)
+
+  job_weeks = plan['job_weeks']
+
+  if incremental:
+    print(f'Incremental run: {len(year_week_departments_to_align)}/{len(year_week_department_list)} weeks to align')
+
+  if len(year_week_departments_to_align) > 0:
+    print(
+      f'Variants: {len(job_weeks)} distinct alignments for {len(year_week_departments_to_align)} weeks '
+      f'(dedup ratio {len(year_week_departments_to_align) / len(job_weeks):.2f})'
     )
 
+  # petri_nets can contain the nets of the weeks already built with build_petri_nets (with the same should_consider_reserves)
+  petri_nets = {} if petri_nets is None else dict(petri_nets)
+
+  # nets to be saved are built here, so that they can be exported while the alignments are computed
+  # (in low-memory mode they are built when they are exported, and dropped right after)
+  if petri_nets_path is not None and not low_memory:
+    with stage('build_petri_nets'):
+      petri_nets = {
+        **build_petri_nets(
+          partitions,
+          [year_week_department for year_week_department in year_week_departments_to_align if year_week_department not in petri_nets],
+          should_consider_reserves
+        ),
+        **petri_nets,
+      }
+
+  # each job aligns the first week of a variant
+  # the day_sequence engine doesn't need the nets, so they aren't sent to the workers
+  def get_job(weeks):
+    year_week_department = weeks[0][1]
+
+    return (
+      year_week_department, *get_partition(year_week_department), should_consider_reserves, cache_path, engine,
+      petri_nets.get(year_week_department) if engine != 'day_sequence' else None, max_time, max_states, should_index_deviations
+    )
+
+  # in low-memory mode the jobs are generated as the workers consume them
+  jobs = map(get_job, job_weeks)
+  if not low_memory:
+    jobs = list(jobs)
+
+  with stage('align_weeks', weeks=len(year_week_departments_to_align), alignments=len(job_weeks)), ExitStack() as exit_stack:
+    export_petri_net = None
+    if petri_nets_path is not None:
+      export_petri_net = exit_stack.enter_context(petri_net_exporter(petri_nets_store_path, format=petri_nets_format))
+
+    def on_result(job_idx, alignment_result):
+      store_job_result(
+        results_store, job_weeks[job_idx], alignment_result, should_index_deviations,
+        lambda week: get_partition(week[1])
+      )
+
+      for _, year_week_department, _, _ in job_weeks[job_idx]:
+        # queued in the background as soon as the week is aligned (waits only if too many exports are pending)
+        if export_petri_net is not None:
+          petri_net = petri_nets.pop(year_week_department, None) if low_memory else petri_nets[year_week_department]
+          if petri_net is None:
+            petri_net = build_petri_net_for_week(get_partition(year_week_department)[0], year_week_department, should_consider_reserves)
+
+          if petri_net[0] is not None:
+            export_petri_net(*petri_net, os.path.join(petri_nets_path, f'{year_week_department}-{should_consider_reserves}'))
+
+    alignment_results = run_alignment_jobs(
+      jobs, n_workers=n_workers, chunk_size=chunk_size, on_result=on_result, total=len(job_weeks),
+      engine=engine,
+    )
+
+  report_alignment_results(alignment_results, job_weeks, cache_path, cache_max_size)
+
+  aligned = {}
+  for weeks, alignment_result in zip(job_weeks, alignment_results):
+    for _, year_week_department, _, _ in weeks:
+      aligned[year_week_department] = alignment_result[0]
+
+  # keep the same order as a full run
+  for year_week_department in year_week_department_list:
+    if year_week_department in aligned:
+      alignment_res = aligned[year_week_department]
+    else:
+      alignment_res = stored_results[year_week_department][1]
+
+    if alignment_res == None:
+      skipped.append(year_week_department)
+      continue
+
     results[year_week_department] = alignment_res
 
+  # weeks whose results have to be aggregated again: the aligned ones and the ones that disappeared from the dataset
+  year_week_department_set = set(year_week_department_list)
+  changed = year_week_departments_to_align + [
+    year_week_department for year_week_department in stored_results if year_week_department not in year_week_department_set
+  ]
+
+  if results_store is not None:
+    set_stored_year_week_departments(results_store, scenario, year_week_department_list)
+    results_store.close()
+
   # save results to json file
   with open(os.path.join(output_path, output_filename), 'w') as f:
     json.dump(results, f, indent=2)
+
+  return results, changed
+
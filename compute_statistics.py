@@ -1,78 +1,147 @@
+import os
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pandas as pd
-from datetime import datetime, timedelta, time
-import matplotlib.pyplot as plt
+from tqdm import tqdm
 
 from config import *
+from load_dataset import load_schedule
+from occupancy import OCCUPANCY_COLUMNS, load_occupancy, build_occupancy, get_room_day_ids, get_busy_periods, get_occupancy_matrix, segmented_cummax, to_minutes
+from instrumentation import stage, write_run_report
+from spill_dataset import spill_dataset, load_partition
+from worker_pool import get_worker_context
 
-def plot_boxplot(data, labels, xlabel, ylabel, title, xticks_rotation=0):
-  # Create boxplot
-  plt.figure(figsize=(10, 6))
-  plt.boxplot(data, patch_artist=True)
-
-  # Add labels and title
-  plt.xlabel(xlabel)
-  plt.ylabel(ylabel)
-  plt.title(title)
-  plt.xticks(ticks=range(1, len(data) + 1), labels=labels, rotation=xticks_rotation)
-  plt.tight_layout()
-  plt.show()
-
-
-def plot_barplot(data, labels, xlabel, ylabel, title, xticks_rotation=0):
-  # Create bar plot
-  plt.figure(figsize=(10, 6))
-  plt.bar(range(len(data)), data, tick_label=labels)
-
-  # Add labels and title
-  plt.xlabel(xlabel)
-  plt.ylabel(ylabel)
-  plt.title(title)
-  plt.xticks(rotation=xticks_rotation)
-  plt.tight_layout()
-  plt.show()
+STATISTICS = ['room_usage', 'usage_and_overtime', 'room_idle_time', 'concurrent_rooms']
 
+# Modules preloaded by the workers that render the plots (see get_worker_context)
+PLOT_WORKER_MODULES = ['compute_statistics', 'matplotlib.figure', 'matplotlib.backends.backend_agg']
 
-# what_to_plot can be either 'usage' or 'num_operations'
-def compute_room_usage(data, what_to_plot='usage'):
-  days_and_rooms = data['Data_Sala'].unique()
-  room_usage_per_day = {}
-
-  for day_and_room in days_and_rooms:
-    day, room = day_and_room.split('-')
-
-    # convert day number to date
-    start_date = datetime(1900, 1, 1)
-    date = start_date + timedelta(days=int(day))
-    date = date.strftime('%d/%m/%Y')
-
-    # create dict to store info about that date
-    if date not in room_usage_per_day:
-      room_usage_per_day[date] = {}
+# Plots are drawn on a standalone Figure (not through pyplot), so they are rendered straight to output_file
+# without any GUI backend and can be rendered from worker processes
+# matplotlib is imported by the plots themselves, so that computing the statistics doesn't load it
 
-    room_usage_per_day[date][room] = {}
+def plot_boxplot(data, labels, xlabel, ylabel, title, output_file, xticks_rotation=0):
+  from matplotlib.figure import Figure
 
-    # get operations performed on that date and room
-    facts = data[data['Data_Sala'] == day_and_room]
+  # Create boxplot
+  fig = Figure(figsize=(10, 6))
+  ax = fig.subplots()
+  ax.boxplot(data, patch_artist=True)
 
-    # count number of operations performed
-    room_usage_per_day[date][room]['num_operations'] = len(facts)
+  # Add labels and title
+  ax.set_xlabel(xlabel)
+  ax.set_ylabel(ylabel)
+  ax.set_title(title)
+  ax.set_xticks(ticks=range(1, len(data) + 1), labels=labels, rotation=xticks_rotation)
+  fig.tight_layout()
+  fig.savefig(output_file)
 
-    # count number of hours that the room has been used in that day
-    facts['T_OCCUP_SALA'] = facts['T_OCCUP_SALA'].str.replace(',', '.').astype(float)
-    room_usage_per_day[date][room]['usage'] = facts['T_OCCUP_SALA'].sum() * 24
 
+def plot_barplot(data, labels, xlabel, ylabel, title, output_file, xticks_rotation=0):
+  from matplotlib.figure import Figure
 
-  usage_per_room = {}
+  # Create bar plot
+  fig = Figure(figsize=(10, 6))
+  ax = fig.subplots()
+  ax.bar(range(len(data)), data, tick_label=labels)
 
-  for date, rooms in room_usage_per_day.items():
-    for room, data in rooms.items():
-      room = int(room)
-      if room not in usage_per_room:
-        usage_per_room[room] = { 'usage': [], 'num_operations': [] }
+  # Add labels and title
+  ax.set_xlabel(xlabel)
+  ax.set_ylabel(ylabel)
+  ax.set_title(title)
+  ax.tick_params(axis='x', labelrotation=xticks_rotation)
+  fig.tight_layout()
+  fig.savefig(output_file)
+
+
+# executor.map passes a single argument, so unpack the (plot function, args) tuple here
+def _render_plot_job(job):
+  plot_function, args = job
+  plot_function(*args)
+
+
+# Render the given (plot function, args) plots, in parallel if n_workers > 1
+def render_plots(plots, n_workers=1):
+  if n_workers > 1:
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=get_worker_context(PLOT_WORKER_MODULES)) as executor:
+      list(executor.map(_render_plot_job, plots))
+  else:
+    for plot in plots:
+      _render_plot_job(plot)
+
+
+# Usage (hours) and number of operations of each room in each day, as a tidy dataframe with columns date, room, usage, num_operations
+# occupancy is the output of load_occupancy (or build_occupancy), rooms and days are the ones of Data_Sala
+def compute_room_usage(occupancy):
+  offsets = occupancy['room_day_offsets']
+
+  # T_OCCUP_SALA is a fraction of a day
+  usage = np.bincount(
+    get_room_day_ids(occupancy),
+    weights=np.nan_to_num(occupancy['occupancy'][:offsets[-1]]),
+    minlength=len(offsets) - 1,
+  ) * 24
+
+  return pd.DataFrame({
+    'date': pd.to_datetime(occupancy['room_day_dates']),
+    'room': occupancy['room_day_rooms'],
+    'usage': usage,
+    'num_operations': np.diff(offsets),
+  })
+
+
+# Busy and idle time (hours) of each room in each day, between the entry of its first operation and the exit of the
+# last one, as a tidy dataframe with columns date, room, first_entry, last_exit, busy, idle, num_gaps (idle periods
+# between operations); overlapping operations are counted once
+def compute_room_idle_time(occupancy):
+  room_day_ids, busy_start, busy_end, gaps = get_busy_periods(occupancy)
+  n_room_days = len(occupancy['room_day_offsets']) - 1
+
+  first_entry = np.full(n_room_days, np.nan)
+  last_exit = np.full(n_room_days, np.nan)
+  np.fmin.at(first_entry, room_day_ids, busy_start)
+  np.fmax.at(last_exit, room_day_ids, busy_end)
+
+  busy = np.bincount(room_day_ids, weights=busy_end - busy_start, minlength=n_room_days)
+  num_gaps = np.bincount(room_day_ids, weights=gaps > 0, minlength=n_room_days).astype(int)
+
+  # room-days without any operation with entry and exit times are left out
+  is_timed = ~np.isnan(first_entry)
+
+  return pd.DataFrame({
+    'date': pd.to_datetime(occupancy['room_day_dates'][is_timed]),
+    'room': occupancy['room_day_rooms'][is_timed],
+    'first_entry': pd.to_datetime(first_entry[is_timed], unit='m'),
+    'last_exit': pd.to_datetime(last_exit[is_timed], unit='m'),
+    'busy': busy[is_timed] / 60,
+    'idle': (last_exit - first_entry - busy)[is_timed] / 60,
+    'num_gaps': num_gaps[is_timed],
+  })
+
+
+# Rooms busy at the same time on each day, from the occupancy matrix (see get_occupancy_matrix), as a tidy dataframe
+# with columns date, rooms (rooms used in the day), peak_rooms (maximum number of rooms busy in the same bucket),
+# mean_rooms (average number of busy rooms over the buckets with at least one) and busy (hours of all the rooms)
+def compute_concurrent_rooms(occupancy, bucket_minutes=OCCUPANCY_BUCKET_MINUTES):
+  days, _, matrix = get_occupancy_matrix(occupancy, bucket_minutes)
+
+  busy_rooms = (matrix > 0).sum(axis=1)
+  busy_buckets = (busy_rooms > 0).sum(axis=1)
+
+  return pd.DataFrame({
+    'date': pd.to_datetime(days),
+    'rooms': (matrix.sum(axis=2) > 0).sum(axis=1),
+    'peak_rooms': busy_rooms.max(axis=1, initial=0),
+    'mean_rooms': busy_rooms.sum(axis=1) / np.maximum(busy_buckets, 1),
+    'busy': matrix.sum(axis=(1, 2), dtype=np.int64) / 60,
+  })
 
-      usage_per_room[room]['usage'].append(data['usage'])
-      usage_per_room[room]['num_operations'].append(data['num_operations'])
 
+# what_to_plot can be either 'usage' or 'num_operations'
+def plot_room_usage(room_usage, what_to_plot='usage', output_file='room_usage.png'):
+  usage_per_room = room_usage.groupby('room', sort=True)[what_to_plot].apply(list)
 
   if what_to_plot == 'usage':
     ylabel = 'Room usage (hours)'
@@ -82,11 +151,12 @@ def compute_room_usage(data, what_to_plot='usage'):
     title = 'Operation number by room (day average)'
   
   plot_boxplot(
-    [usage_per_room[room][what_to_plot] for room in sorted(usage_per_room.keys())],
-    labels=sorted(usage_per_room.keys()),
+    usage_per_room.tolist(),
+    labels=usage_per_room.index.tolist(),
     xlabel='Room code',
     ylabel=ylabel,
-    title=title
+    title=title,
+    output_file=output_file,
   )
 
 
@@ -109,124 +179,105 @@ def compute_room_usage(data, what_to_plot='usage'):
 #   ...
 # }
 # a questo punto posso fare più plot: (1) ritardo medio giornaliero per ciascun reparto, magari con un boxplot, oppure (2) ritardo per ciascuna settimana scomposto nei reparti che hanno causato tale ritardo (istogramma, con ogni barra che rappresenta una settimana e ha più colori uno per reparto)
-def compute_usage_and_overtime(actual, schedule_dataset_path='DIM_TURNI_REPARTO.csv'):
-  results = {}
-  
-  schedule = pd.read_csv(schedule_dataset_path, sep=';', encoding='iso-8859-1')
+def compute_usage_and_overtime(occupancy, schedule_dataset_path=SCHEDULE_PATH):
+  schedule = load_schedule(schedule_dataset_path)
+  schedule = schedule[schedule[TIMESTAMP_KEY].notna()]
+
+  # shifts are processed date by date (in order of appearance), then in schedule order
+  schedule = schedule.iloc[np.argsort(pd.factorize(schedule[TIMESTAMP_KEY])[0], kind='stable')].reset_index(drop=True)
+
+  # every scheduled date appears in the results, even if no department could be computed for it
+  dates = schedule[TIMESTAMP_KEY].unique()
+  results = { date.strftime('%d/%m/%Y'): {} for date in dates }
+
+  # scheduled shifts (one each, identified by their position in the schedule), as indices in the occupancy index
+  shift_dates = schedule[TIMESTAMP_KEY].to_numpy().astype('datetime64[D]').astype(np.int64)
+  shift_departments = pd.Index(occupancy['departments']).get_indexer(schedule['REPARTO'].astype(object))
+  shift_rooms = pd.Index(occupancy['rooms']).get_indexer(schedule['SALA_PREV_EX_POST'].astype(object))
+  shift_start = to_minutes(schedule[TIMESTAMP_KEY] + pd.to_timedelta(schedule['TURNO_START'].astype(int), unit='h'))
+  shift_end = to_minutes(schedule[TIMESTAMP_KEY] + pd.to_timedelta(schedule['TURNO_END'].astype(int), unit='h'))
+
+  # operations that were scheduled (i.e. no urgencies, emergencies, and some elections), sorted by (date, room,
+  # department, entry time): the operations of each shift are a contiguous run
+  # NOTA: ho scelto di usare ENTRATA_SALA invece di ENTRATA_GRUPPO ad esempio
+  operations = np.flatnonzero(
+    occupancy['is_scheduled'] & ~np.isnat(occupancy['date']) & (occupancy['department'] >= 0) & (occupancy['room'] >= 0)
+  )
+
+  n_departments, n_rooms = len(occupancy['departments']), len(occupancy['rooms'])
+
+  def get_keys(dates, rooms, departments):
+    return (dates * n_rooms + rooms) * n_departments + departments
+
+  keys = get_keys(occupancy['date'][operations].astype(np.int64), occupancy['room'][operations], occupancy['department'][operations])
+  order = np.lexsort((occupancy['start'][operations], keys))
+  operations, keys = operations[order], keys[order]
+  start, end = occupancy['start'][operations], occupancy['end'][operations]
+
+  # NOTA: qui stiamo escludendo le operazioni actual di department che però sono state eseguite in un'altra sala (può succedere, ma come mai?)
+  shift_keys = get_keys(shift_dates, shift_rooms, shift_departments)
+  shift_first = np.searchsorted(keys, shift_keys, side='left')
+  shift_last = np.searchsorted(keys, shift_keys, side='right')
+  shift_last[(shift_rooms < 0) | (shift_departments < 0)] = shift_first[(shift_rooms < 0) | (shift_departments < 0)]
+
+  # Check whether there are any overlaps between the operations of a shift (it's a dataset problem: there shouldn't be 2 operations performed on the same time in the same room!)
+  # With operations sorted by start, an operation overlaps a previous one iff it lasts some time and starts before the latest end among the previous ones
+  run_ids = np.cumsum(np.diff(keys, prepend=keys[:1]) != 0)
+  previous_max_end = np.full(len(end), np.nan)
+  if len(end) > 0:
+    previous_max_end[1:] = segmented_cummax(end, run_ids)[:-1]
+    previous_max_end[np.flatnonzero(np.diff(run_ids, prepend=-1) != 0)] = np.nan
 
-  dates = schedule[TIMESTAMP_KEY].unique().tolist()
+  is_overlapping = (previous_max_end > start) & (end > start)
+  overlaps = np.concatenate([[0], np.cumsum(is_overlapping)])
+
+  # usage is the part of the operation inside the shift, overtime the part outside it (in seconds), for each operation
+  # of each shift
+  num_operations = shift_last - shift_first
+  pair_shifts = np.repeat(np.arange(len(schedule)), num_operations)
+  pair_operations = np.arange(len(pair_shifts)) - np.repeat(np.cumsum(num_operations) - num_operations - shift_first, num_operations)
+
+  pair_start, pair_end = start[pair_operations], end[pair_operations]
+  pair_shift_start, pair_shift_end = shift_start[pair_shifts], shift_end[pair_shifts]
+
+  usage = np.maximum(np.minimum(pair_end, pair_shift_end) - np.maximum(pair_start, pair_shift_start), 0) * 60
+  overtime = (np.maximum(pair_shift_start - pair_start, 0) + np.maximum(pair_end - pair_shift_end, 0)) * 60
+
+  shift_usage = np.bincount(pair_shifts, weights=np.nan_to_num(usage), minlength=len(schedule))
+  shift_overtime = np.bincount(pair_shifts, weights=np.nan_to_num(overtime), minlength=len(schedule))
+  shift_duration = (shift_end - shift_start) * 60
+
+  shift_date_labels = schedule[TIMESTAMP_KEY].dt.strftime('%d/%m/%Y').tolist()
+  shift_department_names = schedule['REPARTO'].astype(object).tolist()
+
+  # populate the results dict, following the order of the schedule (shifts without operations are left out)
+  for shift in np.flatnonzero(num_operations > 0).tolist():
+    date = shift_date_labels[shift]
+    department = shift_department_names[shift]
+
+    if overlaps[shift_last[shift]] > overlaps[shift_first[shift]]:
+      print(f'Skipping {department} on {date} because of overlapping operations')
+      continue
 
-  for date in dates:
-    if type(date) is not str:
+    if shift_duration[shift] <= 0:
+      print(f'Skipping {department} on {date} because of an empty shift')
       continue
 
-    results[date] = {}
-    day, month, year = [int(part) for part in date.split('/')]
-
-    schedules_on_date = schedule[schedule[TIMESTAMP_KEY] == date]
-    operations_on_date = actual[actual[TIMESTAMP_KEY] == date]
-
-    # remove operations that weren't scheduled (i.e. urgencies, emergencies, and some elections)
-    operations_on_date = operations_on_date[operations_on_date['LKP_PAZ_DATA_PREV-ACT'] == 1]
-
-    for _, department_schedule in schedules_on_date.iterrows():
-      department, room = department_schedule['REPARTO'], department_schedule['SALA_PREV_EX_POST']
-      
-      # NOTA: qui stiamo escludendo le operazioni actual di department che però sono state eseguite in un'altra sala (può succedere, ma come mai?)
-      operations_on_date_on_department_and_room = operations_on_date[(operations_on_date['REPARTO'] == department) & (operations_on_date['COD_SALA'] == room)]
-
-      scheduled_time = (
-        datetime(year, month, day, int(department_schedule['TURNO_START']), 0),
-        datetime(year, month, day, int(department_schedule['TURNO_END']), 0)
-      )
-      
-      actual_times = []
-
-      for _, operation in operations_on_date_on_department_and_room.iterrows():
-        date_format = '%d/%m/%Y %H:%M'
-
-        # NOTA: ho scelto di usare ENTRATA_SALA invece di ENTRATA_GRUPPO ad esempio
-        actual_times.append((
-          datetime.strptime(operation['ENTRATA_SALA'], date_format),
-          datetime.strptime(operation['USCITA_SALA'], date_format)
-        ))
-
-      # Helper function to calculate overlap between two intervals
-      def overlap(interval1, interval2):
-        start1, end1 = interval1
-        start2, end2 = interval2
-        
-        start = max(start1, start2)
-        end = min(end1, end2)
-        
-        # If the intervals overlap, return the overlap duration, otherwise return 0
-        return max(timedelta(0), end - start)
-
-      # Helper function to calculate the duration of an interval
-      def interval_duration(interval):
-        start, end = interval
-
-        return end - start
-      
-
-      # Function to calculate usage and overtime
-      def calculate_usage_overtime(scheduled_interval, actual_interval):
-        # Calculate overlap
-        usage = overlap(scheduled_interval, actual_interval)
-        
-        # Calculate overtime
-        overtime = timedelta(0)
-        start_scheduled_interval, end_scheduled_interval = scheduled_interval
-        start_actual_interval, end_actual_interval = actual_interval
-        
-        if start_actual_interval < start_scheduled_interval:
-            overtime += (start_scheduled_interval - start_actual_interval)
-        if end_actual_interval > end_scheduled_interval:
-            overtime += (end_actual_interval - end_scheduled_interval)
-        
-        return usage, overtime
-      
-
-      # Check whether there are any overlaps in actual_times
-      # If there is at least 1, then skip the computations (it's a dataset problem: there shouldn't be 2 operations performed on the same time in the same room!)
-      should_skip_computation = False
-
-      for i in range(len(actual_times)):
-        for j in range(i+1, len(actual_times)):
-          usage, _ = calculate_usage_overtime(actual_times[i], actual_times[j])
-
-          if usage.total_seconds() > 0:
-            print(f'Skipping {department} on {date} because of overlapping operations on times {actual_times[i]} and {actual_times[j]}')
-            print(operations_on_date_on_department_and_room)
-            should_skip_computation = True
-
-      if should_skip_computation: continue
-      
-      # Compute usage and overtime
-      department_usage, department_overtime = timedelta(0), timedelta(0)
-
-      for actual_time in actual_times:
-        operation_usage, operation_overtime = calculate_usage_overtime(scheduled_time, actual_time)
-        department_usage += operation_usage
-        department_overtime += operation_overtime
-
-      department_usage_perc = department_usage.total_seconds() / interval_duration(scheduled_time).total_seconds()
-
-      if len(actual_times) == 0: continue
-      if department_usage_perc > 1.0:
-        print(f'Skipping {department} on {date} because usage > 1 ({department_usage_perc})')
-        continue
-
-      # populate the results dict
-      results[date][department] = {
-        'usage': department_usage_perc,
-        'overtime': department_overtime.total_seconds(),
-      }
+    department_usage_perc = shift_usage[shift] / shift_duration[shift]
+
+    if department_usage_perc > 1.0:
+      print(f'Skipping {department} on {date} because usage > 1 ({department_usage_perc})')
+      continue
+
+    results[date][department] = {
+      'usage': department_usage_perc,
+      'overtime': shift_overtime[shift],
+    }
 
   return results
 
 
-def plot_usage_and_overtime_by_department(results):
+def plot_usage_and_overtime_by_department(results, output_path='output'):
   usage_and_overtime_by_department = {}
 
   for result_on_date in results.values():
@@ -253,6 +304,7 @@ def plot_usage_and_overtime_by_department(results):
     xlabel='Department',
     ylabel='Usage (%)',
     title='Usage by department (day average)',
+    output_file=os.path.join(output_path, 'usage_by_department.png'),
     xticks_rotation=90,
   )
 
@@ -262,21 +314,128 @@ def plot_usage_and_overtime_by_department(results):
     xlabel='Department',
     ylabel='Overtime (minutes)',
     title='Overtime by department (day average)',
+    output_file=os.path.join(output_path, 'overtime_by_department.png'),
     xticks_rotation=90,
   )
 
 
 
-# load dataset
-dataset = pd.read_csv('dataset.csv', sep=';', encoding='iso-8859-1')
+# { statistic: result } of the given statistics on an occupancy index
+def compute_statistics(occupancy, stats=STATISTICS, schedule_dataset_path=SCHEDULE_PATH, unit=None):
+  num_operations = len(occupancy['start'])
+  statistics = {}
+
+  if 'room_usage' in stats:
+    with stage('compute_room_usage', unit, operations=num_operations):
+      statistics['room_usage'] = compute_room_usage(occupancy)
+
+  if 'usage_and_overtime' in stats:
+    with stage('compute_usage_and_overtime', unit, operations=num_operations):
+      statistics['usage_and_overtime'] = compute_usage_and_overtime(occupancy, schedule_dataset_path=schedule_dataset_path)
+
+  if 'room_idle_time' in stats:
+    with stage('compute_room_idle_time', unit, operations=num_operations):
+      statistics['room_idle_time'] = compute_room_idle_time(occupancy)
+
+  if 'concurrent_rooms' in stats:
+    with stage('compute_concurrent_rooms', unit, operations=num_operations):
+      statistics['concurrent_rooms'] = compute_concurrent_rooms(occupancy)
+
+  return statistics
+
+# Same as compute_statistics, on the month partitions of the actual operations (see spill_dataset), one at a time
+# Shifts are matched by DATA, so each of them is computed within a single month; a room-day whose Data_Sala is in
+# another month than the DATA of some of its operations has its usage summed over the months, its idle time and
+# concurrent rooms computed in each month
+def compute_partitioned_statistics(partitions, stats=STATISTICS, schedule_dataset_path=SCHEDULE_PATH):
+  partition_statistics = []
+
+  for partition_idx, month in enumerate(tqdm(partitions['keys'])):
+    with stage('build_occupancy', month):
+      occupancy = build_occupancy(load_partition(partitions, partition_idx))
+
+    partition_statistics.append(compute_statistics(occupancy, stats, schedule_dataset_path, unit=month))
+    del occupancy
+
+  statistics = {}
+
+  if 'room_usage' in stats:
+    room_usage = pd.concat([partition['room_usage'] for partition in partition_statistics], ignore_index=True)
+    statistics['room_usage'] = room_usage.groupby(['date', 'room'], sort=False, as_index=False)[['usage', 'num_operations']].sum()
+
+  # every result has all the scheduled dates, the departments of each date come from the month of the date
+  if 'usage_and_overtime' in stats:
+    results = {}
+    for partition in partition_statistics:
+      for date, results_on_date in partition['usage_and_overtime'].items():
+        results.setdefault(date, {}).update(results_on_date)
+
+    statistics['usage_and_overtime'] = results
+
+  for statistic in ['room_idle_time', 'concurrent_rooms']:
+    if statistic in stats:
+      statistics[statistic] = pd.concat([partition[statistic] for partition in partition_statistics], ignore_index=True)
+
+  return statistics
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Compute room usage and overtime statistics of the operating rooms')
+  parser.add_argument('--dataset', default=DATASET_PATH, help='path of the dataset csv')
+  parser.add_argument('--schedule', default=SCHEDULE_PATH, help='path of the department schedule csv (DIM_TURNI_REPARTO)')
+  parser.add_argument('--output', default=os.path.join(OUTPUT_PATH, 'statistics'), help='folder where results and plots are saved')
+  parser.add_argument('--stats', nargs='+', choices=STATISTICS, default=STATISTICS, help='statistics to compute')
+  parser.add_argument('--n-workers', type=int, default=STATISTICS_N_WORKERS, help='number of processes used to render the plots')
+  parser.add_argument('--out-of-core', action='store_true', default=OUT_OF_CORE, help='compute the statistics one month of the dataset at a time (see OUT_OF_CORE)')
+  args = parser.parse_args(argv)
+
+  os.makedirs(args.output, exist_ok=True)
+
+  # occupancy index of the actual operations (the dataset is loaded only if the index must be built again), in
+  # out-of-core mode the statistics are computed month by month instead
+  if args.out_of_core:
+    with stage('spill_dataset'):
+      month_partitions = spill_dataset(args.dataset, kind='month', columns=OCCUPANCY_COLUMNS, slice_val=SLICE_ACTUAL_VAL)
+
+    print(f'Computing statistics of {len(month_partitions["keys"])} month partitions...')
+    statistics = compute_partitioned_statistics(month_partitions, args.stats, schedule_dataset_path=args.schedule)
+  else:
+    with stage('load_occupancy'):
+      occupancy = load_occupancy(args.dataset)
+
+    print('Computing statistics...')
+    statistics = compute_statistics(occupancy, args.stats, schedule_dataset_path=args.schedule)
+
+  # save statistics
+  plots = []
+
+  if 'room_usage' in args.stats:
+    room_usage = statistics['room_usage']
+    room_usage.to_csv(os.path.join(args.output, 'room_usage.csv'), index=False)
+
+    plots.append((plot_room_usage, (room_usage, 'usage', os.path.join(args.output, 'room_usage.png'))))
+    plots.append((plot_room_usage, (room_usage, 'num_operations', os.path.join(args.output, 'room_num_operations.png'))))
+
+  if 'usage_and_overtime' in args.stats:
+    results = statistics['usage_and_overtime']
+
+    with open(os.path.join(args.output, 'usage_and_overtime.json'), 'w') as f:
+      json.dump(results, f, indent=2)
+
+    plots.append((plot_usage_and_overtime_by_department, (results, args.output)))
+
+  if 'room_idle_time' in args.stats:
+    statistics['room_idle_time'].to_csv(os.path.join(args.output, 'room_idle_time.csv'), index=False)
+
+  if 'concurrent_rooms' in args.stats:
+    statistics['concurrent_rooms'].to_csv(os.path.join(args.output, 'concurrent_rooms.csv'), index=False)
 
-# keep only actual operations
-actual, prev = dataset[dataset[SLICE_KEY] == SLICE_ACTUAL_VAL], dataset[dataset[SLICE_KEY] == SLICE_PREV_VAL]
+  print('Rendering plots...')
+  with stage('render_plots', plots=len(plots)):
+    render_plots(plots, n_workers=args.n_workers)
 
-# compute statistics
-compute_room_usage(actual, what_to_plot='usage')
-compute_room_usage(actual, what_to_plot='num_operations')
+  write_run_report(args.output)
 
-results = compute_usage_and_overtime(actual, schedule_dataset_path='./DIM_TURNI_REPARTO.csv')
 
-plot_usage_and_overtime_by_department(results)
\ No newline at end of file
+if __name__ == '__main__':
+  main()
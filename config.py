@@ -2,6 +2,26 @@ DATASET_PATH = 'dataset.csv'
 DATASET_SEP = ';'
 DATASET_ENCODING = 'iso-8859-1'
 
+SCHEDULE_PATH = 'DIM_TURNI_REPARTO.csv'
+
+# Columns read from the datasets and their types (columns not listed in the types are inferred by pandas)
+# Loaded datasets are also saved as a parquet snapshot next to the csv, which is used until the csv changes
+DATASET_COLUMNS = [
+  'Year_Week_Reparto', 'ID_PAZ_DATA', 'DATA', 'SLICE', 'TIPO_URGENZA', 'RISERVA', 'REPARTO', 'COD_SALA',
+  'Data_Sala', 'T_OCCUP_SALA', 'ENTRATA_SALA', 'USCITA_SALA', 'LKP_PAZ_DATA_PREV-ACT',
+]
+DATASET_CATEGORICAL_COLUMNS = ['REPARTO', 'SLICE', 'TIPO_URGENZA', 'COD_SALA']
+DATASET_DATE_COLUMNS = { 'DATA': '%d/%m/%Y', 'ENTRATA_SALA': '%d/%m/%Y %H:%M', 'USCITA_SALA': '%d/%m/%Y %H:%M' }
+DATASET_DECIMAL_COLUMNS = ['T_OCCUP_SALA']
+
+# Columns converted to categoricals when the dataset is loaded in low-memory mode (see LOW_MEMORY)
+DATASET_LOW_MEMORY_CATEGORICAL_COLUMNS = ['Year_Week_Reparto']
+
+SCHEDULE_COLUMNS = ['DATA', 'REPARTO', 'SALA_PREV_EX_POST', 'TURNO_START', 'TURNO_END']
+SCHEDULE_CATEGORICAL_COLUMNS = ['REPARTO']
+SCHEDULE_DATE_COLUMNS = { 'DATA': '%d/%m/%Y' }
+SCHEDULE_DECIMAL_COLUMNS = []
+
 OUTPUT_PATH = 'output'
 
 SLICE_KEY = 'SLICE'
@@ -12,4 +32,83 @@ YEAR_WEEK_DEPARTMENT_KEY = 'Year_Week_Reparto'
 ACTIVITY_KEY = 'ID_PAZ_DATA'
 TIMESTAMP_KEY = 'DATA'
 URGENCY_TYPE_KEY = 'TIPO_URGENZA'
-RESERVE_KEY = 'RISERVA'
\ No newline at end of file
+RESERVE_KEY = 'RISERVA'
+
+# Number of worker processes used to compute alignments (1 = serial) and number of weeks sent to each worker at a time
+ALIGNMENT_N_WORKERS = 1
+ALIGNMENT_CHUNK_SIZE = 1
+
+# Start method of the worker processes (see worker_pool.py): 'forkserver' (workers are forked from a server process that
+# already imported the pipeline modules), 'spawn', 'fork', or None for the default of the platform
+# With 'forkserver' and 'spawn' the workers import the driver script again: scripts that run the alignments with
+# ALIGNMENT_N_WORKERS > 1 need an if __name__ == '__main__' guard (as the run_*.py scripts have), or 'fork'
+WORKER_START_METHOD = 'forkserver'
+
+# Persistent cache of alignment results (set ALIGNMENT_CACHE_PATH to None to disable it) and its maximum size in bytes
+ALIGNMENT_CACHE_PATH = 'output/alignment_cache.sqlite'
+ALIGNMENT_CACHE_MAX_SIZE = 256 * 1024 * 1024
+
+# Engine used to compute alignment fitness: 'pm4py' (A* alignments), 'day_sequence' (specialized for the nets built by
+# build_petri_net_for_week, much faster) or 'cross_check' (computes both and checks that they agree)
+# day_sequence is opt-in: run a dataset with 'cross_check' before switching to it
+ALIGNMENT_ENGINE = 'pm4py'
+
+# Low-memory mode of the alignment pipeline, for long multi-year histories: the dataset is loaded with categorical keys
+# and integer activity ids (see compact_dataset), and compute_alignment neither copies nor casts it, but materializes
+# one week at a time, so that peak memory is bounded by the largest week (plus the jobs being aligned) instead of
+# several copies of the whole dataset
+LOW_MEMORY = False
+
+# Out-of-core mode of the alignment and statistics pipelines, for exports that don't fit in memory: the csv is read in
+# chunks of DATASET_CHUNK_SIZE rows and spilled into on-disk partitions next to it (one per Year_Week_Reparto for the
+# alignments, one per month for the statistics, see spill_dataset.py), which are then processed one at a time
+OUT_OF_CORE = False
+DATASET_CHUNK_SIZE = 200000
+
+# Budget of each A* alignment (engine 'pm4py', and the weeks the day_sequence engine can't handle): maximum time in
+# seconds and maximum estimated number of states (see estimate_state_space), None = unbounded
+# Weeks that exceed the budget get an upper bound of their fitness instead, flagged as approximate in the results
+ALIGNMENT_MAX_TIME = None
+ALIGNMENT_MAX_STATES = None
+
+# Index the moves of every alignment (which planned operations were performed, skipped, moved to another day or added)
+# in the results store of the run, to be queried with deviation_index.py
+# Off by default: it tracks the moves of every alignment, writes them for every week and doesn't reuse the cached
+# results stored without moves
+DEVIATION_INDEX = False
+
+# Name of the output folder reused by incremental runs (only the weeks that changed since the previous run are aligned
+# again), None to create a new timestamped output folder on each run
+INCREMENTAL_RUN_NAME = None
+
+# Scenario matrix computed by run_scenarios.py: every combination of urgency types, reserves and period is a scenario,
+# named after the keys of its values joined by '_' (dimensions with a single value are left out of the name)
+# Periods are (start, end) dates ('YYYY-MM-DD', None = unbounded) of the first operation of the weeks to consider
+SCENARIO_URGENCY_TYPES = { 'e': ['Elezione'], 'eue': ['Elezione', 'Urgenza', 'Emergenza'] }
+SCENARIO_RESERVES = { 'noreserves': False } # e.g. { 'reserves': True, 'noreserves': False }
+SCENARIO_PERIODS = { 'all': (None, None) } # e.g. { 'covid': ('2020-03-01', '2021-06-30'), 'post_covid': ('2021-07-01', None) }
+
+# Time windows of period_analysis.py: length of the rolling windows (in weeks) and custom periods, as (start, end)
+# dates ('YYYY-MM-DD', None = unbounded) like SCENARIO_PERIODS
+ANALYSIS_ROLLING_WEEKS = 4
+ANALYSIS_PERIODS = { 'covid': ('2020-03-01', '2021-06-30'), 'post_covid': ('2021-07-01', None) }
+
+# Petri nets (saved when should_save_petri_nets=True) are exported in background threads while alignments are computed
+# Format 'svg' renders them with graphviz, 'gv' only writes their DOT source (render it later with petri_net_export.py)
+# Each distinct net is exported once in PETRI_NETS_STORE_PATH and reused by the following scenarios and runs
+PETRI_NETS_FORMAT = 'svg'
+PETRI_NETS_STORE_PATH = 'output/petri_nets_store'
+PETRI_NETS_EXPORT_N_THREADS = 2
+PETRI_NETS_EXPORT_MAX_BACKLOG = 64
+
+# Length in minutes of the buckets of the occupancy matrix of the operating rooms (see get_occupancy_matrix), used to
+# measure how many rooms are busy at the same time
+OCCUPANCY_BUCKET_MINUTES = 15
+
+# Number of worker processes used to render the statistics plots (1 = serial)
+STATISTICS_N_WORKERS = 1
+
+# Import-time budget (seconds) of each pipeline module, checked by the startup benchmark (see benchmark.py): importing
+# a module in a fresh interpreter must take at most this long and must not load the libraries imported lazily (pm4py,
+# matplotlib, graphviz), which are loaded only by the stages that use them
+STARTUP_IMPORT_BUDGET = 1.0
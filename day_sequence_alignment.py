@@ -0,0 +1,230 @@
+from collections import Counter
+
+from config import *
+
+# Alignment-based fitness specialized for the nets built by build_petri_net_for_week
+#
+# Those nets are a sequence of days: on day i every planned operation can be performed in any order, then the silent
+# transition day-i closes the day. A reserve operation of day i (when reserves are considered) can also be performed
+# during day i+1, i.e. before day-(i+1) fires. Every complete run of the net performs every planned operation and every
+# day-i transition exactly once, so an optimal alignment is the one with the maximum number of synchronous moves.
+# This holds only if every day has at least one operation that is not a reserve (see is_day_sequence).
+# The trace is split into consecutive segments, one per day, and each segment is matched greedily with the operations
+# available that day: this replaces the A* search over all the interleavings of the operations of a day.
+
+# same costs as the standard cost function of pm4py alignments
+MODEL_LOG_MOVE_COST = 10000
+TAU_MOVE_COST = 1
+
+# Per-day planned operations of a week, as a list of (planned, reserves) multisets of activities
+# ops must contain only the (already cast) planned operations of a single year_week_department, see partition_dataset
+def get_planned_days(ops, should_consider_reserves=True):
+  days = []
+
+  for _, ops_date in ops.groupby(TIMESTAMP_KEY, sort=True):
+    planned, reserves = Counter(), Counter()
+
+    for activity, reserve in zip(ops_date[ACTIVITY_KEY], ops_date[RESERVE_KEY]):
+      if should_consider_reserves and reserve == 1:
+        reserves[activity] += 1
+      else:
+        planned[activity] += 1
+
+    days.append((planned, reserves))
+
+  # reserves of the last day have no next day, in the net they are linked to the last day-i transition
+  if len(days) > 0:
+    planned, reserves = days[-1]
+    days[-1] = (planned + reserves, Counter())
+
+  return days
+
+# In the net, day-i waits only for the non-reserve operations of day i (and the reserves of day i-1): if day i is made
+# only of reserves, day-i doesn't wait for day-(i-1) and the days are no longer a sequence, so this engine doesn't apply
+def is_day_sequence(days):
+  return all(sum(planned.values()) > 0 for planned, _ in days)
+
+# States reached after the last day by the alignment of the trace with the net described by days, as { (number of trace
+# events consumed, leftover reserves): maximum number of synchronous moves }
+# If parents is a list, the state each state of day i comes from is appended to it as a dict, to recover the alignment
+def _align_day_sequence(days, trace, parents=None):
+  n = len(trace)
+
+  # a leftover reserve is useful only if its activity still occurs in the rest of the trace
+  last_occurrence = { activity: i for i, activity in enumerate(trace) }
+
+  # state: (number of trace events already consumed, reserves of the previous day still available) -> sync moves
+  states = { (0, ()): 0 }
+
+  for day_idx, (planned, reserves) in enumerate(days):
+    is_last_day = day_idx == len(days) - 1
+    next_states = {}
+    day_parents = {}
+
+    for (start, leftover), sync_moves in states.items():
+      available_leftover = dict(leftover)
+      available_planned = dict(planned)
+      available_reserves = dict(reserves)
+      matched = 0
+
+      # trace[start:end] is the segment performed during this day
+      for end in range(start, n + 1):
+        if end > start:
+          activity = trace[end - 1]
+
+          # prefer operations that can't be used on the next day
+          if available_leftover.get(activity, 0) > 0:
+            available_leftover[activity] -= 1
+            matched += 1
+          elif available_planned.get(activity, 0) > 0:
+            available_planned[activity] -= 1
+            matched += 1
+          elif available_reserves.get(activity, 0) > 0:
+            available_reserves[activity] -= 1
+            matched += 1
+
+        # the last day must consume the rest of the trace
+        if is_last_day and end < n:
+          continue
+
+        next_leftover = tuple(sorted(
+          (activity, count) for activity, count in available_reserves.items()
+          if count > 0 and last_occurrence.get(activity, -1) >= end
+        ))
+
+        key = (end, next_leftover)
+        if next_states.get(key, -1) < sync_moves + matched:
+          next_states[key] = sync_moves + matched
+          day_parents[key] = (start, leftover)
+
+    states = next_states
+    if parents is not None:
+      parents.append(day_parents)
+
+  return states
+
+# Maximum number of synchronous moves between the trace and any complete run of the net described by days
+def count_sync_moves(days, trace):
+  states = _align_day_sequence(days, trace)
+
+  return max(states.values()) if len(states) > 0 else 0
+
+# Add to moves a move on model for each planned operation of days without a synchronous move, see get_day_sequence_moves
+def add_model_moves(days, moves):
+  synced = Counter((activity, day_idx) for move, activity, day_idx, _ in moves if move == 'sync')
+
+  for day_idx, (planned, reserves) in enumerate(days):
+    for activity, count in (planned + reserves).items():
+      moves.extend([('model', activity, day_idx, None)] * (count - synced[(activity, day_idx)]))
+
+  return moves
+
+# Moves of an optimal alignment of the trace with the net described by days, as a list of (move, activity, day index,
+# event index): synchronous moves ('sync') have both, moves on log ('log') have no day and moves on model ('model') have
+# no event. The day of a synchronous move is the day its operation was planned (the previous one for a leftover reserve)
+def get_day_sequence_moves(days, trace):
+  parents = []
+  states = _align_day_sequence(days, trace, parents)
+
+  # walk back from the best final state to the segment of the trace performed during each day
+  key = max(states, key=states.get)
+  segments = []
+
+  for day_idx in reversed(range(len(days))):
+    parent = parents[day_idx][key]
+    segments.append((day_idx, parent, key[0]))
+    key = parent
+
+  moves = []
+
+  # same greedy matching of each segment as _align_day_sequence
+  for day_idx, (start, leftover), end in reversed(segments):
+    planned, reserves = days[day_idx]
+    available_leftover = dict(leftover)
+    available_planned = dict(planned)
+    available_reserves = dict(reserves)
+
+    for event_idx in range(start, end):
+      activity = trace[event_idx]
+
+      if available_leftover.get(activity, 0) > 0:
+        available_leftover[activity] -= 1
+        moves.append(('sync', activity, day_idx - 1, event_idx))
+      elif available_planned.get(activity, 0) > 0:
+        available_planned[activity] -= 1
+        moves.append(('sync', activity, day_idx, event_idx))
+      elif available_reserves.get(activity, 0) > 0:
+        available_reserves[activity] -= 1
+        moves.append(('sync', activity, day_idx, event_idx))
+      else:
+        moves.append(('log', activity, None, event_idx))
+
+  return add_model_moves(days, moves)
+
+# Fitness dict (same keys as pm4py.conformance.fitness_alignments on a log made of the single trace) of an alignment of
+# the trace with sync_moves synchronous moves
+def _fitness_from_sync_moves(days, trace, sync_moves):
+  if len(trace) == 0:
+    return {
+      'percFitTraces': 0.0,
+      'averageFitness': 0.0,
+      'percentage_of_fitting_traces': 0.0,
+      'average_trace_fitness': 0.0,
+      'log_fitness': 0.0,
+    }
+
+  num_planned = sum(sum(planned.values()) + sum(reserves.values()) for planned, reserves in days)
+  num_moves = len(trace) + num_planned
+
+  # every unmatched event is a move on log, every unmatched planned operation is a move on model
+  deviations = num_moves - 2 * sync_moves
+
+  cost = deviations * MODEL_LOG_MOVE_COST + len(days) * TAU_MOVE_COST
+  best_worst_cost = num_moves * MODEL_LOG_MOVE_COST + len(days) * TAU_MOVE_COST
+
+  fitness = 1 - deviations / num_moves
+  perc_fit_traces = 100.0 if fitness == 1.0 else 0.0
+
+  return {
+    'percFitTraces': perc_fit_traces,
+    'averageFitness': fitness,
+    'percentage_of_fitting_traces': perc_fit_traces,
+    'average_trace_fitness': fitness,
+    'log_fitness': 1.0 - cost / best_worst_cost,
+  }
+
+# Same output as pm4py.conformance.fitness_alignments on a log made of the single trace
+def day_sequence_fitness(days, trace):
+  return _fitness_from_sync_moves(days, trace, count_sync_moves(days, trace))
+
+# Same as day_sequence_fitness, from the moves of an optimal alignment (see get_day_sequence_moves)
+def fitness_from_moves(days, trace, moves):
+  return _fitness_from_sync_moves(days, trace, sum(1 for move in moves if move[0] == 'sync'))
+
+# Cheap upper bound of the alignment fitness of the trace, for weeks whose alignment is too expensive (see align_week)
+# A synchronous move pairs an event with a planned operation of the same activity, so their number is at most the size
+# of the intersection of the planned and actual multisets of activities, whatever the order of the days. Unlike
+# day_sequence_fitness it holds for any week, also the ones that aren't a day sequence
+def multiset_fitness_bound(days, trace):
+  planned = Counter()
+  for day_planned, day_reserves in days:
+    planned.update(day_planned)
+    planned.update(day_reserves)
+
+  sync_moves = sum((planned & Counter(trace)).values())
+
+  return _fitness_from_sync_moves(days, trace, sync_moves)
+
+# Rough size of the state space explored by the A* alignment of the trace, used as a budget before running it
+# The markings of the net are the subsets of the operations of a day (plus the reserves of the previous day) already
+# performed, each combined with any position in the trace
+def estimate_state_space(days, trace):
+  markings = 0
+  previous_reserves = 0
+
+  for planned, reserves in days:
+    num_reserves = sum(reserves.values())
+    markings += 2 ** (sum(planned.values()) + num_reserves + previous_reserves)
+    previous_reserves = num_reserves
+
+  return markings * (len(trace) + 1)
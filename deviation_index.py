@@ -0,0 +1,165 @@
+import os
+import argparse
+import sqlite3
+import pandas as pd
+
+from config import *
+
+# Per-operation index of the deviations between planned and actual operations, built from the moves of the alignments
+# and stored in the moves table of the results store (see results_store.py) as soon as each week is aligned, so that
+# questions about single operations are answered with an indexed query instead of aligning the weeks again
+# Every move of an alignment is a row, classified as
+# - performed: synchronous move, the planned operation was performed
+# - skipped: move on model of an activity never performed in its week
+# - moved: move on model of an activity also performed in its week (as a move on log), and that move on log: the
+#   operation was performed, but not when planned; both rows have the planned and the actual day
+# - added: move on log of an activity not planned in its week
+# e.g. python deviation_index.py --run "output/2024-01-01 10-00-00" --scenario e --deviation skipped --top 10
+
+DEVIATIONS = ['performed', 'skipped', 'moved', 'added']
+
+DEVIATION_COLUMNS = ['year_week_department', 'department', 'activity', 'deviation', 'planned_day', 'actual_day']
+
+# a moved operation has two rows (its moves on model and on log), an operation is counted once by skipping the second
+ONE_ROW_PER_OPERATION = "(move != 'log' OR deviation = 'added')"
+
+# Deviation rows (activity, move, deviation, planned day, actual day) of a week from the moves of its alignment (see
+# get_day_sequence_moves), dated with its planned (prev) and actual (act) operations; days are 'YYYY-MM-DD' strings
+# prev and act are the (already cast) operations of the week the moves come from, or of a week with the same variant
+def get_week_deviations(moves, prev, act):
+  planned_days = pd.Series(prev[TIMESTAMP_KEY].unique()).dt.strftime('%Y-%m-%d').tolist()
+  actual_days = act[TIMESTAMP_KEY].dt.strftime('%Y-%m-%d').tolist()
+
+  # day of the first move on model and on log of each activity, to date the other side of moved operations
+  model_days, log_days = {}, {}
+  for move, activity, day_idx, event_idx in moves:
+    if move == 'model':
+      model_days.setdefault(activity, planned_days[day_idx])
+    elif move == 'log':
+      log_days.setdefault(activity, actual_days[event_idx])
+
+  deviations = []
+
+  for move, activity, day_idx, event_idx in moves:
+    planned_day = None if day_idx is None else planned_days[day_idx]
+    actual_day = None if event_idx is None else actual_days[event_idx]
+
+    if move == 'sync':
+      deviation = 'performed'
+    elif move == 'model':
+      actual_day = log_days.get(activity)
+      deviation = 'skipped' if actual_day is None else 'moved'
+    else:
+      planned_day = model_days.get(activity)
+      deviation = 'added' if planned_day is None else 'moved'
+
+    deviations.append((activity, move, deviation, planned_day, actual_day))
+
+  return deviations
+
+def _query(results_store_path, query, params):
+  conn = sqlite3.connect(results_store_path, timeout=60)
+
+  try:
+    return pd.read_sql_query(query, conn, params=params)
+  finally:
+    conn.close()
+
+def _get_filters(scenario, deviations, start, end, departments):
+  filters = ['scenario = ?', f'deviation IN ({", ".join("?" for _ in deviations)})', ONE_ROW_PER_OPERATION]
+  params = [scenario, *deviations]
+
+  # an operation is in the date range if it was planned or performed in it (both ends included)
+  if start is not None or end is not None:
+    start, end = start or '0000-00-00', end or '9999-99-99'
+    filters.append('(planned_day BETWEEN ? AND ? OR actual_day BETWEEN ? AND ?)')
+    params += [start, end, start, end]
+
+  if departments is not None:
+    filters.append(f'department IN ({", ".join("?" for _ in departments)})')
+    params += departments
+
+  return ' AND '.join(filters), params
+
+# Operations of a scenario with the given deviations (one row each), planned or performed between start and end
+# ('YYYY-MM-DD', None = unbounded) in the given departments (None = all), with only the given columns
+def read_deviations(
+  results_store_path,
+  scenario,
+  deviations=DEVIATIONS,
+  start=None,
+  end=None,
+  departments=None,
+  columns=DEVIATION_COLUMNS,
+):
+  filters, params = _get_filters(scenario, deviations, start, end, departments)
+
+  return _query(
+    results_store_path,
+    f'SELECT {", ".join(columns)} FROM moves WHERE {filters} ORDER BY year_week_department, planned_day, actual_day',
+    params,
+  )
+
+# Number of operations of each deviation by the given columns (e.g. ['department'] or ['year', 'week']), one column
+# per deviation
+def count_deviations(results_store_path, scenario, by=['department'], start=None, end=None, departments=None):
+  filters, params = _get_filters(scenario, DEVIATIONS, start, end, departments)
+
+  counts = _query(
+    results_store_path,
+    f'SELECT {", ".join(by)}, deviation, COUNT(*) AS operations FROM moves WHERE {filters} GROUP BY {", ".join(by)}, deviation',
+    params,
+  )
+
+  counts = counts.pivot_table(index=by, columns='deviation', values='operations', aggfunc='sum', fill_value=0)
+
+  return counts.reindex(columns=DEVIATIONS, fill_value=0).astype(int)
+
+# The top_n activities with the most operations with the given deviation in each department, as (department, activity,
+# operations) rows sorted by department and decreasing number of operations
+def get_top_deviations(results_store_path, scenario, deviation='skipped', top_n=10, start=None, end=None, departments=None):
+  filters, params = _get_filters(scenario, [deviation], start, end, departments)
+
+  counts = _query(
+    results_store_path,
+    f'SELECT department, activity, COUNT(*) AS operations FROM moves WHERE {filters} GROUP BY department, activity',
+    params,
+  )
+
+  counts = counts.sort_values(by=['department', 'operations', 'activity'], ascending=[True, False, True], kind='stable')
+
+  return counts.groupby('department', sort=False).head(top_n).reset_index(drop=True)
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Query the deviations of the planned operations from the alignments of a run')
+  parser.add_argument('--run', required=True, help='output folder of an alignment run, with its results.sqlite')
+  parser.add_argument('--scenario', default='e', help='scenario of the run')
+  parser.add_argument('--deviation', nargs='+', choices=DEVIATIONS, default=['skipped', 'moved', 'added'], help='deviations to consider')
+  parser.add_argument('--start', default=None, help='first day (YYYY-MM-DD) an operation is planned or performed')
+  parser.add_argument('--end', default=None, help='last day (YYYY-MM-DD) an operation is planned or performed')
+  parser.add_argument('--departments', nargs='+', default=None, help='departments to consider (default: all)')
+  parser.add_argument('--top', type=int, default=None, help='print the activities with the most deviations in each department')
+  parser.add_argument('--output', default=None, help='csv file where the operations are saved')
+  args = parser.parse_args(argv)
+
+  results_store_path = os.path.join(args.run, 'results.sqlite')
+
+  print(count_deviations(results_store_path, args.scenario, start=args.start, end=args.end, departments=args.departments).to_string())
+
+  if args.top is not None:
+    for deviation in args.deviation:
+      print(f'Top {args.top} {deviation} activities by department:')
+      print(get_top_deviations(
+        results_store_path, args.scenario, deviation, args.top, start=args.start, end=args.end, departments=args.departments
+      ).to_string(index=False))
+
+  if args.output is not None:
+    operations = read_deviations(
+      results_store_path, args.scenario, args.deviation, start=args.start, end=args.end, departments=args.departments
+    )
+    operations.to_csv(args.output, index=False)
+    print(f'Saved {len(operations)} operations in {args.output}')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,162 @@
+import os
+import random
+import argparse
+from datetime import date, datetime, timedelta
+import pandas as pd
+
+from config import *
+
+# Synthetic exports with the same columns and formats as dataset.csv and DIM_TURNI_REPARTO.csv, to run and benchmark
+# the pipelines without the real (confidential) data
+#
+# Every department has its own rooms and a shift per room on each working day. Each day some operations are planned
+# (some of them as reserves), and each of them is actually performed in the planned room unless it deviates: with
+# probability deviation_rate it is either not performed or performed the day after. The actual operations of a room are
+# performed one after the other from the start of the shift, so late days produce overtime. A few urgent operations are
+# performed without being planned.
+
+URGENCY_TYPES = ['Elezione', 'Urgenza', 'Emergenza']
+WORKING_DAYS_PER_WEEK = 5
+
+def generate_synthetic_dataset(
+  n_departments=4,
+  n_weeks=6,
+  operations_per_day=4,
+  deviation_rate=0.2,
+  reserve_rate=0.2,
+  urgent_rate=0.2,
+  rooms_per_department=1,
+  start_date=date(2020, 1, 6),
+  seed=0,
+):
+  rnd = random.Random(seed)
+
+  # start on a monday, so that the working days of each week share the same Year_Week_Reparto
+  start_date = start_date - timedelta(days=start_date.weekday())
+
+  departments = [f'Reparto{department_idx}' for department_idx in range(n_departments)]
+  rows = []
+  schedule_rows = []
+  operation_id = 100000
+
+  for week_idx in range(n_weeks):
+    for department_idx, department in enumerate(departments):
+      rooms = [10 + department_idx * rooms_per_department + room_idx for room_idx in range(rooms_per_department)]
+
+      for day_idx in range(WORKING_DAYS_PER_WEEK):
+        day = start_date + timedelta(days=7 * week_idx + day_idx)
+        year, week, _ = day.isocalendar()
+        year_week_department = f'{year}-{week:02d}-{department}'
+
+        for room in rooms:
+          shift_start, shift_end = 8, rnd.choice([14, 14, 20])
+          schedule_rows.append({
+            'DATA': day.strftime('%d/%m/%Y'),
+            'REPARTO': department,
+            'SALA_PREV_EX_POST': room,
+            'TURNO_START': shift_start,
+            'TURNO_END': shift_end,
+          })
+
+          # operations of the room start with the shift (sometimes a bit earlier) and follow each other, the ones moved to
+          # the next day are performed in the evening
+          next_start = datetime(day.year, day.month, day.day, shift_start) - timedelta(minutes=rnd.choice([0, 0, 0, 10, 15, 30]))
+          next_moved_start = datetime(day.year, day.month, day.day, 20, 30) + timedelta(days=1)
+
+          for _ in range(rnd.randint(1, operations_per_day)):
+            operation_id += 1
+
+            is_planned = rnd.random() >= urgent_rate / 2
+            operation = {
+              'Year_Week_Reparto': year_week_department,
+              'ID_PAZ_DATA': operation_id,
+              'TIPO_URGENZA': 'Elezione' if rnd.random() >= urgent_rate else rnd.choice(URGENCY_TYPES[1:]),
+              'RISERVA': int(rnd.random() < reserve_rate),
+              'REPARTO': department,
+              'COD_SALA': room,
+            }
+
+            if is_planned:
+              rows.append({ **operation, 'SLICE': SLICE_PREV_VAL, 'DATA': day.strftime('%d/%m/%Y') })
+
+            deviation = rnd.random()
+            if is_planned and deviation < deviation_rate / 2:
+              continue
+
+            # moved to the next working day (of the same week)
+            actual_day = day
+            if is_planned and deviation < deviation_rate and day_idx < WORKING_DAYS_PER_WEEK - 1:
+              actual_day = day + timedelta(days=1)
+
+            duration = rnd.randint(30, 180)
+
+            if actual_day == day:
+              entry_time = next_start
+              next_start = entry_time + timedelta(minutes=duration + rnd.randint(5, 20))
+            else:
+              entry_time = next_moved_start
+              next_moved_start = entry_time + timedelta(minutes=duration + rnd.randint(5, 20))
+
+            exit_time = entry_time + timedelta(minutes=duration)
+
+            rows.append({
+              **operation,
+              'SLICE': SLICE_ACTUAL_VAL,
+              'DATA': actual_day.strftime('%d/%m/%Y'),
+              'Data_Sala': f'{(actual_day - date(1900, 1, 1)).days}-{room}',
+              'T_OCCUP_SALA': f'{duration / (24 * 60):.6f}'.replace('.', ','),
+              'ENTRATA_SALA': entry_time.strftime('%d/%m/%Y %H:%M'),
+              'USCITA_SALA': exit_time.strftime('%d/%m/%Y %H:%M'),
+              'LKP_PAZ_DATA_PREV-ACT': int(rnd.random() >= 0.05),
+            })
+
+  # the exports are not sorted
+  rnd.shuffle(rows)
+
+  dataset = pd.DataFrame(rows, columns=DATASET_COLUMNS)
+  schedule = pd.DataFrame(schedule_rows, columns=SCHEDULE_COLUMNS)
+
+  return dataset, schedule
+
+# Save the synthetic exports as output_path/dataset.csv and output_path/DIM_TURNI_REPARTO.csv, returning their paths
+def save_synthetic_dataset(dataset, schedule, output_path):
+  os.makedirs(output_path, exist_ok=True)
+
+  dataset_path = os.path.join(output_path, os.path.basename(DATASET_PATH))
+  schedule_path = os.path.join(output_path, os.path.basename(SCHEDULE_PATH))
+
+  dataset.to_csv(dataset_path, sep=DATASET_SEP, encoding=DATASET_ENCODING, index=False)
+  schedule.to_csv(schedule_path, sep=DATASET_SEP, encoding=DATASET_ENCODING, index=False)
+
+  return dataset_path, schedule_path
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Generate synthetic dataset.csv and DIM_TURNI_REPARTO.csv exports')
+  parser.add_argument('--output', default=os.path.join(OUTPUT_PATH, 'synthetic'), help='folder where the csv files are saved')
+  parser.add_argument('--departments', type=int, default=4, help='number of departments')
+  parser.add_argument('--weeks', type=int, default=6, help='number of weeks')
+  parser.add_argument('--operations-per-day', type=int, default=4, help='maximum number of operations per room and day')
+  parser.add_argument('--rooms-per-department', type=int, default=1, help='number of rooms of each department')
+  parser.add_argument('--deviation-rate', type=float, default=0.2, help='fraction of planned operations not performed or moved to the next day')
+  parser.add_argument('--reserve-rate', type=float, default=0.2, help='fraction of planned operations that are reserves')
+  parser.add_argument('--urgent-rate', type=float, default=0.2, help='fraction of urgent operations')
+  parser.add_argument('--seed', type=int, default=0, help='random seed')
+  args = parser.parse_args(argv)
+
+  dataset, schedule = generate_synthetic_dataset(
+    n_departments=args.departments,
+    n_weeks=args.weeks,
+    operations_per_day=args.operations_per_day,
+    deviation_rate=args.deviation_rate,
+    reserve_rate=args.reserve_rate,
+    urgent_rate=args.urgent_rate,
+    rooms_per_department=args.rooms_per_department,
+    seed=args.seed,
+  )
+
+  dataset_path, schedule_path = save_synthetic_dataset(dataset, schedule, args.output)
+  print(f'Saved {len(dataset)} operations in {dataset_path} and {len(schedule)} shifts in {schedule_path}')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,141 @@
+import os
+import sys
+import json
+import time
+import importlib.util
+from contextlib import contextmanager
+
+# Lightweight instrumentation of the pipeline stages
+# Every stage() block records its wall time, cpu time and the peak RSS of the process at its end, optionally for a
+# specific unit (e.g. a year_week_department) together with some counts (e.g. number of operations)
+# Records produced in worker processes are captured with capture_records() and sent back to be added with add_records()
+
+if importlib.util.find_spec('resource'):
+  import resource
+else:
+  resource = None
+
+_records = []
+
+# stack of lists where new records are appended (the top one is the current target)
+_record_targets = [_records]
+
+# labels added to every record (e.g. the scenario being computed)
+_labels = {}
+
+_start_time = time.perf_counter()
+
+# Peak resident set size in MB (of this process, or of its terminated children), None if not available
+def get_peak_rss_mb(children=False):
+  if resource is None:
+    return None
+
+  usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+
+  # ru_maxrss is in KB on linux and in bytes on macOS
+  if sys.platform == 'darwin':
+    return usage.ru_maxrss / (1024 * 1024)
+
+  return usage.ru_maxrss / 1024
+
+def set_labels(**labels):
+  _labels.clear()
+  _labels.update(labels)
+
+@contextmanager
+def stage(name, unit=None, **counts):
+  wall_time, cpu_time = time.perf_counter(), time.process_time()
+
+  try:
+    yield
+  finally:
+    _record_targets[-1].append({
+      'stage': name,
+      'unit': unit,
+      'wall_time': time.perf_counter() - wall_time,
+      'cpu_time': time.process_time() - cpu_time,
+      'peak_rss_mb': get_peak_rss_mb(),
+      **counts,
+      **_labels,
+    })
+
+# Collect the records produced inside the block in a separate list instead of the global one
+@contextmanager
+def capture_records():
+  records = []
+  _record_targets.append(records)
+
+  try:
+    yield records
+  finally:
+    _record_targets.pop()
+
+def add_records(records):
+  for record in records:
+    _records.append({ **record, **_labels })
+
+def get_stage_summary():
+  summary = {}
+
+  for record in _records:
+    if record['stage'] not in summary:
+      summary[record['stage']] = {
+        'calls': 0,
+        'units': set(),
+        'wall_time': 0.0,
+        'cpu_time': 0.0,
+        'max_wall_time': 0.0,
+        'peak_rss_mb': None,
+      }
+
+    stage_summary = summary[record['stage']]
+    stage_summary['calls'] += 1
+    stage_summary['wall_time'] += record['wall_time']
+    stage_summary['cpu_time'] += record['cpu_time']
+    stage_summary['max_wall_time'] = max(stage_summary['max_wall_time'], record['wall_time'])
+
+    if record['unit'] is not None:
+      stage_summary['units'].add(record['unit'])
+
+    if record['peak_rss_mb'] is not None:
+      stage_summary['peak_rss_mb'] = max(stage_summary['peak_rss_mb'] or 0, record['peak_rss_mb'])
+
+  for stage_summary in summary.values():
+    stage_summary['units'] = len(stage_summary['units'])
+
+  return summary
+
+def get_slowest_units(stage_name, top_n=10):
+  unit_records = [record for record in _records if record['stage'] == stage_name and record['unit'] is not None]
+
+  return sorted(unit_records, key=lambda record: record['wall_time'], reverse=True)[:top_n]
+
+def print_slowest_units(stage_name, top_n=10):
+  slowest_units = get_slowest_units(stage_name, top_n)
+  if len(slowest_units) == 0:
+    return
+
+  count_keys = [key for key in slowest_units[0] if key not in ('stage', 'unit', 'wall_time', 'cpu_time', 'peak_rss_mb')]
+
+  print(f'Slowest {len(slowest_units)} units of stage "{stage_name}":')
+  print(f'  {"wall (s)":>10} {"cpu (s)":>10} ' + ' '.join(f'{key:>12}' for key in count_keys) + '  unit')
+
+  for record in slowest_units:
+    print(f'  {record["wall_time"]:>10.3f} {record["cpu_time"]:>10.3f} ' + ' '.join(f'{str(record.get(key)):>12}' for key in count_keys) + f'  {record["unit"]}')
+
+# Write run_report.json in output_path and print the slowest units of unit_stage
+def write_run_report(output_path, unit_stage='align_week', top_n=10):
+  report = {
+    'wall_time': time.perf_counter() - _start_time,
+    'cpu_time': time.process_time(),
+    'peak_rss_mb': get_peak_rss_mb(),
+    'peak_rss_children_mb': get_peak_rss_mb(children=True),
+    'stages': get_stage_summary(),
+    f'slowest_{unit_stage}': get_slowest_units(unit_stage, top_n),
+    'records': _records,
+  }
+
+  with open(os.path.join(output_path, 'run_report.json'), 'w') as f:
+    json.dump(report, f, indent=2, default=str)
+
+  print_slowest_units(unit_stage, top_n)
@@ -0,0 +1,173 @@
+import os
+import json
+import hashlib
+import importlib.util
+import pandas as pd
+
+from config import *
+
+# Typed loading of the ';'-separated exports, with a cached parquet snapshot
+# The snapshot (<csv name>.parquet) is rebuilt whenever the csv changes, i.e. when its mtime/size differ from the ones
+# recorded in <csv name>.parquet.json and its hash differs too (so that a simple touch doesn't trigger a rebuild)
+# Other caches derived from the csv (e.g. the occupancy index of occupancy.py) are checked in the same way
+
+def compute_file_hash(path):
+  file_hash = hashlib.sha256()
+
+  with open(path, 'rb') as f:
+    for block in iter(lambda: f.read(1024 * 1024), b''):
+      file_hash.update(block)
+
+  return file_hash.hexdigest()
+
+def _get_column_types(columns, categorical_columns, date_columns, decimal_columns):
+  # only the types of the columns being read
+  date_columns = { column: date_format for column, date_format in date_columns.items() if column in columns }
+  decimal_columns = [column for column in decimal_columns if column in columns]
+  categorical_columns = [column for column in categorical_columns if column in columns]
+
+  return categorical_columns, date_columns, decimal_columns
+
+def _convert_types(df, categorical_columns, date_columns, decimal_columns):
+  for column, date_format in date_columns.items():
+    df[column] = pd.to_datetime(df[column], format=date_format)
+
+  # decimals use ',' as separator
+  for column in decimal_columns:
+    df[column] = df[column].str.replace(',', '.').astype(float)
+
+  # converted after reading, so that categories keep the inferred type (e.g. room codes stay integers)
+  for column in categorical_columns:
+    df[column] = df[column].astype('category')
+
+  return df
+
+def read_typed_csv(path, columns, categorical_columns, date_columns, decimal_columns):
+  categorical_columns, date_columns, decimal_columns = _get_column_types(columns, categorical_columns, date_columns, decimal_columns)
+
+  df = pd.read_csv(
+    path,
+    sep=DATASET_SEP,
+    encoding=DATASET_ENCODING,
+    usecols=columns,
+    dtype={ column: str for column in list(date_columns) + decimal_columns },
+  )
+
+  return _convert_types(df, categorical_columns, date_columns, decimal_columns)
+
+# Same as read_typed_csv, one chunk of chunk_size rows at a time (the index of each chunk continues the previous one)
+# Categorical columns are left as they are, since each chunk would get its own categories
+def read_typed_csv_chunks(path, columns, date_columns, decimal_columns, chunk_size):
+  _, date_columns, decimal_columns = _get_column_types(columns, [], date_columns, decimal_columns)
+
+  chunks = pd.read_csv(
+    path,
+    sep=DATASET_SEP,
+    encoding=DATASET_ENCODING,
+    usecols=columns,
+    dtype={ column: str for column in list(date_columns) + decimal_columns },
+    chunksize=chunk_size,
+  )
+
+  for chunk in chunks:
+    yield _convert_types(chunk, [], date_columns, decimal_columns)
+
+# Whether the snapshot at snapshot_path was built from the current content of path with the given columns, and the info
+# to record (with write_snapshot_info) when the snapshot is built again
+def check_snapshot(path, snapshot_path, columns):
+  snapshot_info_path = f'{snapshot_path}.json'
+
+  stat = os.stat(path)
+  snapshot_info = { 'mtime': stat.st_mtime, 'size': stat.st_size, 'columns': columns }
+
+  previous_snapshot_info = None
+  if os.path.exists(snapshot_path) and os.path.exists(snapshot_info_path):
+    with open(snapshot_info_path) as f:
+      previous_snapshot_info = json.load(f)
+
+  is_snapshot_valid = previous_snapshot_info is not None and previous_snapshot_info['columns'] == columns
+
+  if is_snapshot_valid and (previous_snapshot_info['mtime'], previous_snapshot_info['size']) != (stat.st_mtime, stat.st_size):
+    snapshot_info['hash'] = compute_file_hash(path)
+    is_snapshot_valid = previous_snapshot_info.get('hash') == snapshot_info['hash']
+
+    # same content, just record the new mtime
+    if is_snapshot_valid:
+      with open(snapshot_info_path, 'w') as f:
+        json.dump(snapshot_info, f, indent=2)
+
+  return is_snapshot_valid, snapshot_info
+
+def write_snapshot_info(path, snapshot_path, snapshot_info):
+  if 'hash' not in snapshot_info:
+    snapshot_info['hash'] = compute_file_hash(path)
+
+  with open(f'{snapshot_path}.json', 'w') as f:
+    json.dump(snapshot_info, f, indent=2)
+
+def load_csv(path, columns, categorical_columns, date_columns, decimal_columns, use_snapshot=True, load_columns=None):
+  if load_columns is None:
+    load_columns = columns
+
+  # the snapshot needs pyarrow, without it the csv is always read
+  if not use_snapshot or not importlib.util.find_spec('pyarrow'):
+    return read_typed_csv(path, load_columns, categorical_columns, date_columns, decimal_columns)
+
+  snapshot_path = f'{os.path.splitext(path)[0]}.parquet'
+  is_snapshot_valid, snapshot_info = check_snapshot(path, snapshot_path, columns)
+
+  if is_snapshot_valid:
+    df = pd.read_parquet(snapshot_path, columns=load_columns)
+
+    # parquet doesn't always restore categoricals (e.g. the ones with integer categories)
+    for column in categorical_columns:
+      if column in df.columns and df[column].dtype != 'category':
+        df[column] = df[column].astype('category')
+
+    return df
+
+  print(f'Building snapshot of {path}...')
+
+  df = read_typed_csv(path, columns, categorical_columns, date_columns, decimal_columns)
+  df.to_parquet(snapshot_path, index=False)
+  write_snapshot_info(path, snapshot_path, snapshot_info)
+
+  return df[load_columns]
+
+# Low-memory representation of a loaded dataset (see LOW_MEMORY): the given string columns (e.g. the Year_Week_Reparto
+# keys) become categoricals and integer columns (e.g. the activity ids) are downcast to the smallest type that fits them
+def compact_dataset(df, categorical_columns=DATASET_LOW_MEMORY_CATEGORICAL_COLUMNS):
+  for column in df.columns:
+    if column in categorical_columns:
+      df[column] = df[column].astype('category')
+    elif pd.api.types.is_integer_dtype(df[column]):
+      df[column] = pd.to_numeric(df[column], downcast='integer')
+
+  return df
+
+def load_dataset(path=DATASET_PATH, columns=None, use_snapshot=True, low_memory=False):
+  df = load_csv(
+    path,
+    DATASET_COLUMNS,
+    DATASET_CATEGORICAL_COLUMNS,
+    DATASET_DATE_COLUMNS,
+    DATASET_DECIMAL_COLUMNS,
+    use_snapshot=use_snapshot,
+    load_columns=columns,
+  )
+
+  if low_memory:
+    df = compact_dataset(df)
+
+  return df
+
+def load_schedule(path=SCHEDULE_PATH, columns=None, use_snapshot=True):
+  return load_csv(
+    path,
+    SCHEDULE_COLUMNS,
+    SCHEDULE_CATEGORICAL_COLUMNS,
+    SCHEDULE_DATE_COLUMNS,
+    SCHEDULE_DECIMAL_COLUMNS,
+    use_snapshot=use_snapshot,
+    load_columns=columns,
+  )
@@ -0,0 +1,173 @@
+import os
+import numpy as np
+import pandas as pd
+
+from config import *
+from load_dataset import load_dataset, check_snapshot, write_snapshot_info
+
+# Occupancy index of the operating rooms, built once from the actual operations and shared by the statistics of
+# compute_statistics.py, which derive everything from it with array reductions instead of grouping the DataFrame
+#
+# The operations are sorted by room-day (the '<day number>-<room code>' of Data_Sala, in order of first appearance, the
+# operations without Data_Sala last) and, within each room-day, by entry time: the operations of room-day i are the
+# rows room_day_offsets[i]:room_day_offsets[i + 1] of the per-operation arrays, sorted intervals of the room
+# The index is a dict of numpy arrays, saved as <csv name>.occupancy.npz next to the parquet snapshot of the dataset and
+# rebuilt when the csv changes (see check_snapshot)
+# - room_day_dates, room_day_rooms, room_day_offsets: day, room and first operation of each room-day
+# - date, department, room: DATA, REPARTO and COD_SALA of each operation (department and room are indices in departments
+#   and rooms, -1 if missing), used to match the operations with the scheduled shifts
+# - start, end: ENTRATA_SALA and USCITA_SALA as minutes since 1970-01-01 (NaN if missing)
+# - occupancy: T_OCCUP_SALA (fraction of a day)
+# - is_scheduled: whether the operation was planned (LKP_PAZ_DATA_PREV-ACT = 1)
+
+OCCUPANCY_COLUMNS = [SLICE_KEY, TIMESTAMP_KEY, 'REPARTO', 'COD_SALA', 'Data_Sala', 'T_OCCUP_SALA', 'ENTRATA_SALA', 'USCITA_SALA', 'LKP_PAZ_DATA_PREV-ACT']
+
+# day numbers of Data_Sala count the days since 01/01/1900
+DAY_NUMBER_EPOCH = np.datetime64('1900-01-01', 'D')
+
+MINUTES_PER_DAY = 24 * 60
+
+def to_minutes(datetimes):
+  datetimes = pd.to_datetime(datetimes).to_numpy()
+  minutes = datetimes.astype('datetime64[m]').astype(np.int64).astype(float)
+  minutes[np.isnat(datetimes)] = np.nan
+
+  return minutes
+
+def build_occupancy(actual):
+  room_day_codes, room_day_keys = pd.factorize(actual['Data_Sala'], sort=False)
+  n_room_days = len(room_day_keys)
+
+  day_numbers, room_day_rooms = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+  if n_room_days > 0:
+    day_and_room = pd.Series(room_day_keys).str.split('-', expand=True)
+    day_numbers, room_day_rooms = day_and_room[0].astype(np.int64).to_numpy(), day_and_room[1].astype(np.int64).to_numpy()
+
+  start, end = to_minutes(actual['ENTRATA_SALA']), to_minutes(actual['USCITA_SALA'])
+
+  # operations without a room-day go last, operations without an entry time last in their room-day (lexsort puts NaN last)
+  room_day_codes = np.where(room_day_codes < 0, n_room_days, room_day_codes)
+  order = np.lexsort((start, room_day_codes))
+  room_day_offsets = np.searchsorted(room_day_codes[order], np.arange(n_room_days + 1))
+
+  department_codes, departments = pd.factorize(actual['REPARTO'].astype(object))
+  room_codes, rooms = pd.factorize(actual['COD_SALA'].astype(object))
+
+  return {
+    'room_day_dates': DAY_NUMBER_EPOCH + day_numbers,
+    'room_day_rooms': room_day_rooms,
+    'room_day_offsets': room_day_offsets,
+    'date': actual[TIMESTAMP_KEY].to_numpy().astype('datetime64[D]')[order],
+    'department': department_codes[order],
+    'departments': np.asarray(departments, dtype=object),
+    'room': room_codes[order],
+    'rooms': np.asarray(rooms, dtype=object),
+    'start': start[order],
+    'end': end[order],
+    'occupancy': actual['T_OCCUP_SALA'].to_numpy(dtype=float)[order],
+    'is_scheduled': (actual['LKP_PAZ_DATA_PREV-ACT'] == 1).to_numpy()[order],
+  }
+
+# Occupancy index of the actual operations of the dataset at path, loaded from its cache if the csv didn't change
+def load_occupancy(path=DATASET_PATH, use_snapshot=True):
+  occupancy_path = f'{os.path.splitext(path)[0]}.occupancy.npz'
+
+  if use_snapshot:
+    is_occupancy_valid, occupancy_info = check_snapshot(path, occupancy_path, OCCUPANCY_COLUMNS)
+
+    if is_occupancy_valid:
+      with np.load(occupancy_path, allow_pickle=True) as f:
+        return { key: f[key] for key in f.files }
+
+  if use_snapshot:
+    print(f'Building occupancy index of {path}...')
+
+  dataset = load_dataset(path, columns=OCCUPANCY_COLUMNS, use_snapshot=use_snapshot)
+  occupancy = build_occupancy(dataset[dataset[SLICE_KEY] == SLICE_ACTUAL_VAL])
+
+  if use_snapshot:
+    np.savez(occupancy_path, **occupancy)
+    write_snapshot_info(path, occupancy_path, occupancy_info)
+
+  return occupancy
+
+# Room-day of each operation of the room-days (the operations without Data_Sala are left out)
+def get_room_day_ids(occupancy):
+  offsets = occupancy['room_day_offsets']
+
+  return np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+# Running maximum of values (NaN are ignored) that restarts at each group, group_ids are non-decreasing
+def segmented_cummax(values, group_ids):
+  finite = values[~np.isnan(values)]
+  if len(finite) == 0:
+    return values.copy()
+
+  # shift each group above all the previous ones, so that a single running maximum never crosses groups
+  low = finite.min()
+  shifts = group_ids * (finite.max() - low + 1)
+
+  return np.fmax.accumulate(values - low + shifts) - shifts + low
+
+# Busy periods of the room-days: each operation with entry and exit times contributes its part [busy_start, busy_end)
+# not already covered by the previous operations of its room-day, so the periods of a room-day are disjoint
+# Returns (room-day of each operation, busy_start, busy_end, gap before the operation), gaps are NaN for the first
+# operation of each room-day, busy_start = busy_end for operations entirely covered by previous ones
+def get_busy_periods(occupancy):
+  n = occupancy['room_day_offsets'][-1]
+  room_day_ids = get_room_day_ids(occupancy)
+  start, end = occupancy['start'][:n], occupancy['end'][:n]
+
+  is_timed = ~np.isnan(start) & ~np.isnan(end)
+  room_day_ids, start, end = room_day_ids[is_timed], start[is_timed], end[is_timed]
+
+  # latest exit among the previous operations of the same room-day
+  previous_end = np.full(len(end), np.nan)
+  if len(end) > 0:
+    previous_end[1:] = segmented_cummax(end, room_day_ids)[:-1]
+    previous_end[np.flatnonzero(np.diff(room_day_ids, prepend=-1) != 0)] = np.nan
+
+  busy_start = np.fmax(start, previous_end)
+  busy_end = np.maximum(end, busy_start)
+
+  return room_day_ids, busy_start, busy_end, start - previous_end
+
+# Dense occupancy matrix: (days, rooms, matrix) where matrix[day, room, bucket] is the number of minutes room is busy
+# during the bucket_minutes long bucket of day (from midnight); days and rooms are the sorted ones with a room-day
+# Operations running past midnight are cut at the end of their day
+def get_occupancy_matrix(occupancy, bucket_minutes=OCCUPANCY_BUCKET_MINUTES):
+  days, day_idxs = np.unique(occupancy['room_day_dates'], return_inverse=True)
+  rooms, room_idxs = np.unique(occupancy['room_day_rooms'], return_inverse=True)
+  n_buckets = -(-MINUTES_PER_DAY // bucket_minutes)
+
+  matrix = np.zeros((len(days), len(rooms), n_buckets), dtype=np.uint16)
+
+  room_day_ids, busy_start, busy_end, _ = get_busy_periods(occupancy)
+
+  # busy periods as minutes since the midnight of their room-day, within the day
+  midnight = occupancy['room_day_dates'][room_day_ids].astype('datetime64[m]').astype(np.int64)
+  busy_start = np.clip(busy_start - midnight, 0, MINUTES_PER_DAY).astype(np.int64)
+  busy_end = np.clip(busy_end - midnight, 0, MINUTES_PER_DAY).astype(np.int64)
+
+  is_busy = busy_end > busy_start
+  room_day_ids, busy_start, busy_end = room_day_ids[is_busy], busy_start[is_busy], busy_end[is_busy]
+
+  # split each busy period into the buckets it spans
+  first_bucket = busy_start // bucket_minutes
+  num_buckets = (busy_end - 1) // bucket_minutes - first_bucket + 1
+
+  period_idxs = np.repeat(np.arange(len(busy_start)), num_buckets)
+  buckets = first_bucket[period_idxs] + np.arange(len(period_idxs)) - np.repeat(np.cumsum(num_buckets) - num_buckets, num_buckets)
+
+  minutes = (
+    np.minimum(busy_end[period_idxs], (buckets + 1) * bucket_minutes) -
+    np.maximum(busy_start[period_idxs], buckets * bucket_minutes)
+  )
+
+  np.add.at(
+    matrix,
+    (day_idxs[room_day_ids[period_idxs]], room_idxs[room_day_ids[period_idxs]], buckets),
+    minutes.astype(np.uint16),
+  )
+
+  return days, rooms, matrix
@@ -0,0 +1,194 @@
+import os
+import json
+import argparse
+import numpy as np
+import pandas as pd
+
+from config import *
+from load_dataset import load_dataset
+from analyze_alignment_results import load_results, aggregate_fitness
+
+# Time-windowed analysis of results that were already computed (alignment fitness of each year_week_department, room
+# usage of each day and room, usage and overtime of each day and department), without aligning or recomputing anything
+# Results are indexed once by date (weeks by the date of their first operation, as the periods of run_scenarios.py), so
+# that every window (rolling weeks, quarters, custom periods) is a contiguous slice of the index found in O(log n)
+# e.g. python period_analysis.py --run "output/2024-01-01 10-00-00" --scenarios e eue --statistics output/statistics
+
+WINDOW_KINDS = ['rolling', 'quarters', 'periods']
+
+# Sorted index over dates: (dates in increasing order, position of each of them in the original dates)
+def build_date_index(dates):
+  dates = pd.to_datetime(pd.Series(dates), format='%d/%m/%Y').to_numpy()
+  order = np.argsort(dates, kind='stable')
+
+  return dates[order], order
+
+# Positions (in the original dates, in date order) of the dates between start and end, both included (None = unbounded)
+def slice_date_index(date_index, start=None, end=None):
+  sorted_dates, order = date_index
+
+  start_idx = 0 if start == None else np.searchsorted(sorted_dates, pd.Timestamp(start).to_datetime64(), side='left')
+  end_idx = len(sorted_dates) if end == None else np.searchsorted(sorted_dates, pd.Timestamp(end).to_datetime64(), side='right')
+
+  return order[start_idx:end_idx]
+
+# Index of the year_week_departments of the dataset by the date of their first operation (planned or actual, of any
+# urgency type): (year_week_departments, date index over their first dates)
+def build_week_index(dataset):
+  dates = pd.to_datetime(dataset[TIMESTAMP_KEY], format='%d/%m/%Y')
+  first_dates = dates.groupby(dataset[YEAR_WEEK_DEPARTMENT_KEY], sort=False, observed=True).min()
+
+  return first_dates.index.to_numpy(dtype=object), build_date_index(first_dates)
+
+# { window name: (start, end) } of the given kinds between first_date and last_date
+# - rolling: the rolling_weeks weeks (monday to sunday) ending with each week, named rolling<n>-<year>-<week>
+# - quarters: calendar quarters, named <year>-Q<quarter>
+# - periods: the given { name: (start, end) } periods ('YYYY-MM-DD', None = unbounded)
+def get_windows(first_date, last_date, kinds=WINDOW_KINDS, rolling_weeks=ANALYSIS_ROLLING_WEEKS, periods=ANALYSIS_PERIODS):
+  first_date, last_date = pd.Timestamp(first_date).normalize(), pd.Timestamp(last_date).normalize()
+  windows = {}
+
+  if 'rolling' in kinds:
+    for week_start in pd.date_range(first_date - pd.Timedelta(days=first_date.weekday()), last_date, freq='7D'):
+      year, week, _ = week_start.isocalendar()
+      windows[f'rolling{rolling_weeks}-{year}-{week:02d}'] = (
+        week_start - pd.Timedelta(weeks=rolling_weeks - 1),
+        week_start + pd.Timedelta(days=6),
+      )
+
+  if 'quarters' in kinds:
+    for quarter in pd.period_range(first_date, last_date, freq='Q'):
+      windows[f'{quarter.year}-Q{quarter.quarter}'] = (quarter.start_time, quarter.end_time.normalize())
+
+  if 'periods' in kinds:
+    for name, (start, end) in periods.items():
+      windows[name] = (
+        None if start == None else pd.Timestamp(start),
+        None if end == None else pd.Timestamp(end),
+      )
+
+  return windows
+
+# Apply aggregate(rows) to the rows of frame in each window, where date_index indexes the rows of frame by date
+# Returns the concatenated outputs, with the window name, start and end as first columns
+def aggregate_windows(frame, date_index, windows, aggregate):
+  summaries = []
+
+  for name, (start, end) in windows.items():
+    rows = slice_date_index(date_index, start, end)
+    if len(rows) == 0:
+      continue
+
+    summary = aggregate(frame.iloc[rows]).reset_index()
+    summary.insert(0, 'window', name)
+    summary.insert(1, 'window_start', start)
+    summary.insert(2, 'window_end', end)
+    summaries.append(summary)
+
+  if len(summaries) == 0:
+    return pd.DataFrame(columns=['window', 'window_start', 'window_end'])
+
+  return pd.concat(summaries, ignore_index=True)
+
+# Fitness summary (see aggregate_fitness) of each window, by any columns of load_results (e.g. ['department'])
+# fitness is the output of load_results, week_index the output of build_week_index
+def compute_windowed_fitness(fitness, week_index, windows, by=['department'], percentiles=[]):
+  year_week_departments, week_date_index = week_index
+  first_dates = pd.Series(week_date_index[0], index=year_week_departments[week_date_index[1]])
+
+  fitness = fitness[fitness['year_week_department'].isin(first_dates.index)]
+  date_index = build_date_index(first_dates[fitness['year_week_department']].to_numpy())
+
+  return aggregate_windows(fitness, date_index, windows, lambda rows: aggregate_fitness(rows, by, percentiles))
+
+# Day average of the usage (hours) and number of operations of each room in each window, and the number of days
+# room_usage is the output of compute_room_usage (or its room_usage.csv)
+def compute_windowed_room_usage(room_usage, windows):
+  return aggregate_windows(
+    room_usage,
+    build_date_index(room_usage['date']),
+    windows,
+    lambda rows: rows.groupby('room', sort=True).agg(
+      usage=('usage', 'mean'),
+      num_operations=('num_operations', 'mean'),
+      days=('date', 'size'),
+    ),
+  )
+
+# Day average of the usage (fraction of the shift) and overtime (minutes) of each department in each window, and the
+# number of days; results is the output of compute_usage_and_overtime (or its usage_and_overtime.json)
+def compute_windowed_usage_and_overtime(results, windows):
+  usage_and_overtime = pd.DataFrame(
+    [
+      (date, department, result['usage'], result['overtime'] / 60)
+      for date, results_on_date in results.items()
+      for department, result in results_on_date.items()
+    ],
+    columns=['date', 'department', 'usage', 'overtime'],
+  )
+
+  return aggregate_windows(
+    usage_and_overtime,
+    build_date_index(usage_and_overtime['date']),
+    windows,
+    lambda rows: rows.groupby('department', sort=True).agg(
+      usage=('usage', 'mean'),
+      overtime=('overtime', 'mean'),
+      days=('date', 'size'),
+    ),
+  )
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Aggregate already computed results over many time windows')
+  parser.add_argument('--dataset', default=DATASET_PATH, help='path of the dataset csv (to date the weeks)')
+  parser.add_argument('--run', default=None, help='output folder of an alignment run, with its results.sqlite')
+  parser.add_argument('--scenarios', nargs='+', default=['e', 'eue'], help='scenarios of the run to aggregate')
+  parser.add_argument('--by', nargs='+', default=['department'], help='columns the fitness is grouped by in each window')
+  parser.add_argument('--statistics', default=None, help='output folder of compute_statistics.py')
+  parser.add_argument('--windows', nargs='+', choices=WINDOW_KINDS, default=WINDOW_KINDS, help='kinds of windows')
+  parser.add_argument('--rolling-weeks', type=int, default=ANALYSIS_ROLLING_WEEKS, help='length of the rolling windows in weeks')
+  parser.add_argument('--output', default=None, help='folder where the csv files are saved (default: the run or statistics folder)')
+  args = parser.parse_args(argv)
+
+  dataset = load_dataset(args.dataset, columns=[YEAR_WEEK_DEPARTMENT_KEY, TIMESTAMP_KEY])
+  week_index = build_week_index(dataset)
+
+  dates = week_index[1][0]
+  windows = get_windows(dates[0], dates[-1], kinds=args.windows, rolling_weeks=args.rolling_weeks)
+  print(f'{len(windows)} windows between {pd.Timestamp(dates[0]).date()} and {pd.Timestamp(dates[-1]).date()}')
+
+  if args.run is not None:
+    output_path = args.output or args.run
+    os.makedirs(output_path, exist_ok=True)
+
+    for scenario in args.scenarios:
+      fitness = load_results(args.run, None, results_store_path=os.path.join(args.run, 'results.sqlite'), scenario=scenario)
+
+      windowed_fitness = compute_windowed_fitness(fitness, week_index, windows, by=args.by)
+      windowed_fitness.to_csv(os.path.join(output_path, f'windowed_fitness_{scenario}.csv'), index=False)
+      print(f'Fitness of scenario "{scenario}": {len(windowed_fitness)} rows')
+
+  if args.statistics is not None:
+    output_path = args.output or args.statistics
+    os.makedirs(output_path, exist_ok=True)
+
+    room_usage_path = os.path.join(args.statistics, 'room_usage.csv')
+    if os.path.exists(room_usage_path):
+      room_usage = pd.read_csv(room_usage_path, parse_dates=['date'])
+
+      windowed_room_usage = compute_windowed_room_usage(room_usage, windows)
+      windowed_room_usage.to_csv(os.path.join(output_path, 'windowed_room_usage.csv'), index=False)
+      print(f'Room usage: {len(windowed_room_usage)} rows')
+
+    usage_and_overtime_path = os.path.join(args.statistics, 'usage_and_overtime.json')
+    if os.path.exists(usage_and_overtime_path):
+      with open(usage_and_overtime_path) as f:
+        results = json.load(f)
+
+      windowed_usage_and_overtime = compute_windowed_usage_and_overtime(results, windows)
+      windowed_usage_and_overtime.to_csv(os.path.join(output_path, 'windowed_usage_and_overtime.csv'), index=False)
+      print(f'Usage and overtime: {len(windowed_usage_and_overtime)} rows')
+
+
+if __name__ == '__main__':
+  main()
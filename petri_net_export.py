@@ -0,0 +1,160 @@
+import os
+import shutil
+import hashlib
+import argparse
+import threading
+import importlib.util
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from config import *
+from alignment_cache import compute_cache_key
+
+# Background export of the petri nets of the weeks, off the alignment critical path
+# Every net is stored once in store_path as <net hash>.gv (DOT source) and <net hash>.svg, and linked (or copied) into
+# the output folder as <year_week_department>-<should_consider_reserves>.gv/.svg: nets already exported by a previous
+# scenario or run are not rendered again
+# Nets are deduplicated per week, not across weeks: the hash includes the net name (the week, the title of the render),
+# and the places of a net are named after the dates of its week anyway, so only the same week with the same operations
+# (e.g. in another scenario or run) shares a render
+# With format 'gv' only the DOT source is written (no graphviz binary needed), the svg can be rendered later with
+# render_petri_nets, e.g. only for some weeks: python petri_net_export.py output/<run>/petri_nets --weeks 2020-02-Reparto1
+
+# Nets in format 'svg' are rendered with graphviz, optional (without it petri nets are not saved at all), 'gv' only
+# needs pm4py to write the DOT source
+def can_export_petri_nets(format):
+  return format == 'gv' or importlib.util.find_spec('graphviz') is not None
+
+def compute_net_hash(net, im, fm):
+  # the net name is the title of the rendered net, so it is part of the hash (nets are deduplicated per week)
+  return hashlib.sha256(f'{net.name}|{compute_cache_key(net, im, fm, [])}'.encode('utf-8')).hexdigest()
+
+# Link (or copy, if links aren't supported) source to destination, replacing destination
+def link_file(source, destination):
+  if os.path.exists(destination):
+    os.remove(destination)
+
+  try:
+    os.link(source, destination)
+  except OSError:
+    shutil.copyfile(source, destination)
+
+# files are written to a temporary path and then moved, so that an interrupted export never leaves a partial file
+def write_dot(net, im, fm, dot_path):
+  # imported here, so that the pipelines that import this module load pm4py only when a net is actually exported
+  import pm4py
+
+  if not os.path.exists(dot_path):
+    tmp_path = f'{dot_path}.{threading.get_ident()}.tmp.gv'
+    pm4py.save_vis_petri_net(net, im, fm, tmp_path)
+    os.replace(tmp_path, dot_path)
+
+def render_svg(dot_path, svg_path):
+  # imported here since graphviz is optional (see can_export_petri_nets)
+  import graphviz
+
+  if not os.path.exists(svg_path):
+    tmp_path = f'{svg_path}.{threading.get_ident()}.tmp'
+    with open(dot_path) as f:
+      svg = graphviz.Source(f.read()).pipe(format='svg')
+    with open(tmp_path, 'wb') as f:
+      f.write(svg)
+    os.replace(tmp_path, svg_path)
+
+# Returns True if the net was added to the store (written, and rendered if the format is 'svg'), False if it was already
+# in the store
+def _export_petri_net(net, im, fm, net_hash, output_file, store_path, format, previous_export=None):
+  # the same net is already being exported by another thread
+  if previous_export is not None:
+    previous_export.result()
+
+  dot_path = os.path.join(store_path, f'{net_hash}.gv')
+  stored_path = os.path.join(store_path, f'{net_hash}.{format}')
+  is_new = not os.path.exists(stored_path)
+
+  write_dot(net, im, fm, dot_path)
+  if format == 'svg':
+    render_svg(dot_path, stored_path)
+
+  link_file(stored_path, f'{output_file}.{format}')
+
+  # an svg rendered from a previous export of this week (e.g. in incremental runs) is outdated
+  if format == 'gv' and os.path.exists(f'{output_file}.svg'):
+    os.remove(f'{output_file}.svg')
+
+  return is_new
+
+# Yields a function export_petri_net(net, im, fm, output_file) that queues the export of a net to output_file.<format>
+# At most max_backlog exports are queued at a time (export_petri_net waits for a free slot), all of them are done when
+# the block ends
+@contextmanager
+def petri_net_exporter(store_path, format='svg', n_threads=PETRI_NETS_EXPORT_N_THREADS, max_backlog=PETRI_NETS_EXPORT_MAX_BACKLOG):
+  assert format in ('svg', 'gv'), f'unknown petri nets format {format}'
+
+  os.makedirs(store_path, exist_ok=True)
+
+  backlog = threading.BoundedSemaphore(max_backlog)
+  exports = {}
+  futures = []
+  shared = 0
+
+  with ThreadPoolExecutor(max_workers=n_threads) as executor:
+    def export_petri_net(net, im, fm, output_file):
+      nonlocal shared
+      net_hash = compute_net_hash(net, im, fm)
+
+      # the same net was already exported in this run (e.g. the same week in another scenario), its render is reused
+      if net_hash in exports:
+        shared += 1
+
+      backlog.acquire()
+      future = executor.submit(_export_petri_net, net, im, fm, net_hash, output_file, store_path, format, exports.get(net_hash))
+      future.add_done_callback(lambda _: backlog.release())
+
+      exports.setdefault(net_hash, future)
+      futures.append(future)
+
+    yield export_petri_net
+
+  # errors of any export are raised here
+  for future in futures:
+    future.result()
+
+  # DOT sources are only written, svgs are rendered too
+  # nets shared with a previous export of this run are neither new nor found in the store
+  new = sum(future.result() for future in exports.values())
+  print(
+    f'Petri nets: {len(futures)} exported, {new} {"rendered" if format == "svg" else "written"}, '
+    f'{len(exports) - new} already in {store_path}, {shared} shared within this run'
+  )
+
+# Render the svg of the nets exported as DOT source in petri_nets_path, only for the given year_week_departments if any
+# (nets whose svg already exists are skipped)
+def render_petri_nets(petri_nets_path, year_week_departments=None, n_threads=PETRI_NETS_EXPORT_N_THREADS):
+  dot_files = sorted(
+    filename for filename in os.listdir(petri_nets_path)
+    if filename.endswith('.gv') and (
+      year_week_departments == None or filename.rsplit('-', 1)[0] in year_week_departments
+    )
+  )
+
+  with ThreadPoolExecutor(max_workers=n_threads) as executor:
+    list(executor.map(
+      lambda filename: render_svg(os.path.join(petri_nets_path, filename), os.path.join(petri_nets_path, f'{filename[:-3]}.svg')),
+      dot_files
+    ))
+
+  print(f'Rendered {len(dot_files)} petri nets in {petri_nets_path}')
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Render the svg of the petri nets exported as DOT source (format "gv")')
+  parser.add_argument('petri_nets_path', help='folder with the exported petri nets (output/<run>/petri_nets)')
+  parser.add_argument('--weeks', nargs='+', default=None, help='year_week_departments to render (default: all)')
+  parser.add_argument('--n-threads', type=int, default=PETRI_NETS_EXPORT_N_THREADS, help='number of concurrent renders')
+  args = parser.parse_args(argv)
+
+  render_petri_nets(args.petri_nets_path, args.weeks, n_threads=args.n_threads)
+
+
+if __name__ == '__main__':
+  main()
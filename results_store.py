@@ -0,0 +1,144 @@
+import os
+import sqlite3
+import pandas as pd
+
+from config import *
+
+# Streaming store of alignment results, a SQLite table with one row per (scenario, year_week_department)
+# Results are written as soon as each week is aligned, so an interrupted run can be resumed (see incremental runs of
+# compute_alignment), and aggregations read only the columns they need instead of parsing a whole results json
+# Each row keeps the fingerprint of the rows the week was aligned from and its position in the results of the scenario
+# (the order of the results json); weeks skipped because they have no planned operations have NULL metrics, weeks whose
+# alignment exceeded its budget have approximate = 1 (see align_week)
+# The moves of the alignment of each week are kept in the moves table, one row per move (see deviation_index.py)
+
+RESULT_METRICS = ['percFitTraces', 'averageFitness', 'percentage_of_fitting_traces', 'average_trace_fitness', 'log_fitness']
+
+def open_results_store(results_store_path):
+  results_store_dir = os.path.dirname(results_store_path)
+  if results_store_dir and not os.path.exists(results_store_dir):
+    os.makedirs(results_store_dir, exist_ok=True)
+
+  conn = sqlite3.connect(results_store_path, timeout=60)
+  conn.execute('PRAGMA journal_mode=WAL')
+  conn.execute(f'''
+    CREATE TABLE IF NOT EXISTS results (
+      scenario TEXT NOT NULL,
+      year_week_department TEXT NOT NULL,
+      year INTEGER NOT NULL,
+      week INTEGER NOT NULL,
+      department TEXT NOT NULL,
+      position INTEGER NOT NULL,
+      fingerprint TEXT NOT NULL,
+      {', '.join(f'{metric} REAL' for metric in RESULT_METRICS)},
+      approximate INTEGER NOT NULL DEFAULT 0,
+      PRIMARY KEY (scenario, year_week_department)
+    )
+  ''')
+
+  # stores created before approximate results were introduced
+  if 'approximate' not in [column[1] for column in conn.execute('PRAGMA table_info(results)')]:
+    with conn:
+      conn.execute('ALTER TABLE results ADD COLUMN approximate INTEGER NOT NULL DEFAULT 0')
+
+  conn.execute('''
+    CREATE TABLE IF NOT EXISTS moves (
+      scenario TEXT NOT NULL,
+      year_week_department TEXT NOT NULL,
+      year INTEGER NOT NULL,
+      week INTEGER NOT NULL,
+      department TEXT NOT NULL,
+      activity TEXT NOT NULL,
+      move TEXT NOT NULL,
+      deviation TEXT NOT NULL,
+      planned_day TEXT,
+      actual_day TEXT
+    )
+  ''')
+  conn.execute('CREATE INDEX IF NOT EXISTS moves_week ON moves (scenario, year_week_department)')
+  conn.execute('CREATE INDEX IF NOT EXISTS moves_department ON moves (scenario, deviation, department, activity)')
+  conn.execute('CREATE INDEX IF NOT EXISTS moves_planned_day ON moves (scenario, deviation, planned_day)')
+  conn.execute('CREATE INDEX IF NOT EXISTS moves_actual_day ON moves (scenario, deviation, actual_day)')
+  conn.execute('CREATE INDEX IF NOT EXISTS moves_activity ON moves (scenario, activity)')
+
+  return conn
+
+def put_result(conn, scenario, year_week_department, position, fingerprint, alignment_res):
+  year, week, department = year_week_department.split('-', 2)
+  metrics = [None if alignment_res == None else alignment_res[metric] for metric in RESULT_METRICS]
+  approximate = int(alignment_res != None and alignment_res.get('approximate', False))
+
+  with conn:
+    conn.execute(
+      f'''INSERT OR REPLACE INTO results
+        (scenario, year_week_department, year, week, department, position, fingerprint, {", ".join(RESULT_METRICS)}, approximate)
+        VALUES (?, ?, ?, ?, ?, ?, ?, {", ".join("?" for _ in RESULT_METRICS)}, ?)''',
+      (scenario, year_week_department, int(year), int(week), department, position, fingerprint, *metrics, approximate)
+    )
+
+# Replace the moves of a week with deviations, the rows of get_week_deviations (no rows if its alignment has no moves,
+# i.e. it was skipped or its fitness is approximate)
+def put_deviations(conn, scenario, year_week_department, deviations):
+  year, week, department = year_week_department.split('-', 2)
+
+  with conn:
+    conn.execute('DELETE FROM moves WHERE scenario = ? AND year_week_department = ?', (scenario, year_week_department))
+    conn.executemany(
+      '''INSERT INTO moves
+        (scenario, year_week_department, year, week, department, activity, move, deviation, planned_day, actual_day)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+      [(scenario, year_week_department, int(year), int(week), department, *deviation) for deviation in deviations]
+    )
+
+# { year_week_department: (fingerprint, alignment result or None if skipped, whether its fitness is approximate) } of the
+# scenario
+def get_stored_results(conn, scenario):
+  stored_results = {}
+
+  for year_week_department, fingerprint, approximate, *metrics in conn.execute(
+    f'SELECT year_week_department, fingerprint, approximate, {", ".join(RESULT_METRICS)} FROM results WHERE scenario = ? ORDER BY position',
+    (scenario,)
+  ):
+    alignment_res = None if metrics[0] == None else dict(zip(RESULT_METRICS, metrics))
+    if alignment_res != None and approximate:
+      alignment_res['approximate'] = True
+    stored_results[year_week_department] = (fingerprint, alignment_res, bool(approximate))
+
+  return stored_results
+
+# Keep only the given year_week_departments of the scenario, in the given order
+def set_stored_year_week_departments(conn, scenario, year_week_departments):
+  with conn:
+    conn.execute('CREATE TEMP TABLE IF NOT EXISTS kept (year_week_department TEXT PRIMARY KEY, position INTEGER NOT NULL)')
+    conn.execute('DELETE FROM kept')
+    conn.executemany('INSERT INTO kept VALUES (?, ?)', [(k, position) for position, k in enumerate(year_week_departments)])
+    conn.execute(
+      'DELETE FROM results WHERE scenario = ? AND year_week_department NOT IN (SELECT year_week_department FROM kept)',
+      (scenario,)
+    )
+    conn.execute(
+      'DELETE FROM moves WHERE scenario = ? AND year_week_department NOT IN (SELECT year_week_department FROM kept)',
+      (scenario,)
+    )
+    conn.execute(
+      'UPDATE results SET position = (SELECT position FROM kept WHERE kept.year_week_department = results.year_week_department) WHERE scenario = ?',
+      (scenario,)
+    )
+
+def delete_results(conn, scenario):
+  with conn:
+    conn.execute('DELETE FROM results WHERE scenario = ?', (scenario,))
+    conn.execute('DELETE FROM moves WHERE scenario = ?', (scenario,))
+
+# Results of a scenario (skipped weeks excluded) as a DataFrame with only the given columns, in the order of the results json
+def read_results(results_store_path, scenario, columns=['year_week_department', *RESULT_METRICS]):
+  conn = sqlite3.connect(results_store_path, timeout=60)
+
+  try:
+    return pd.read_sql_query(
+      f'SELECT {", ".join(columns)} FROM results WHERE scenario = ? AND {RESULT_METRICS[0]} IS NOT NULL ORDER BY position',
+      conn,
+      params=(scenario,),
+    )
+  finally:
+    conn.close()
@@ -1,48 +1,102 @@
 import os
 from datetime import datetime
-import pandas as pd
 
 from config import *
+from load_dataset import load_dataset
+from spill_dataset import spill_dataset, get_week_keys
+from instrumentation import stage, set_labels, write_run_report
 from compute_alignment import compute_alignment
 from analyze_alignment_results import compute_average_fitness_by_department, plot_average_fitness_by_department, compute_average_fitness_by_year_week, plot_average_fitness_by_year_week
 
-# Create an output folder for this specific pipeline run
-timestamp = datetime.now().strftime('%Y-%m-%d %H-%M-%S')
-run_output_path = os.path.join(OUTPUT_PATH, timestamp)
-os.makedirs(run_output_path)
-
-# Load the dataset
-dataset = pd.read_csv(DATASET_PATH, sep=DATASET_SEP, encoding=DATASET_ENCODING)
-
-# for period, name in zip(['COVID', 'POST_COVID'], ['covid', 'post_covid']):
-for urgency_types_to_consider, name in zip([['Elezione'], ['Elezione', 'Urgenza', 'Emergenza']], ['e', 'eue']):
-# for should_consider_reserves, name in zip([True, False], ['reserves', 'noreserves']):
-  print(f'Considering case "{name}"...')
-
-  # Compute alignments
-  compute_alignment(
-    dataset=dataset,
-    output_path=run_output_path,
-    output_filename=f'results_{name}.json',
-    urgency_types_to_consider=urgency_types_to_consider,
-    should_consider_reserves=False,
-    should_save_petri_nets=True,
-  )
-
-  # Compute average fitness by department
-  compute_average_fitness_by_year_week(
-    dataset=dataset,
-    output_path=run_output_path,
-    output_filename=f'average_fitness_by_year_week_{name}.json',
-    input_filename=f'results_{name}.json',
-  )
-
-# Plot average fitness by department
-plot_average_fitness_by_year_week(
-  dataset=dataset,
-  output_path=run_output_path,
-  input_filenames=[
-    'average_fitness_by_year_week_e.json',
-    'average_fitness_by_year_week_eue.json',
-  ]
-)
\ No newline at end of file
+def main():
+  # Create an output folder for this specific pipeline run
+  # (incremental runs reuse the same folder, and only align again the weeks that changed since the previous run or that
+  # an interrupted run didn't align, see results_store.py)
+  incremental = INCREMENTAL_RUN_NAME is not None
+
+  if incremental:
+    run_output_path = os.path.join(OUTPUT_PATH, INCREMENTAL_RUN_NAME)
+    os.makedirs(run_output_path, exist_ok=True)
+  else:
+    timestamp = datetime.now().strftime('%Y-%m-%d %H-%M-%S')
+    run_output_path = os.path.join(OUTPUT_PATH, timestamp)
+    os.makedirs(run_output_path)
+
+  # Load the dataset
+  # (in out-of-core mode it is spilled into week partitions instead, and only its weeks are kept in memory)
+  columns = [YEAR_WEEK_DEPARTMENT_KEY, ACTIVITY_KEY, TIMESTAMP_KEY, SLICE_KEY, URGENCY_TYPE_KEY, RESERVE_KEY]
+  week_partitions = None
+
+  with stage('load_dataset'):
+    if OUT_OF_CORE:
+      week_partitions = spill_dataset(kind='week', columns=columns)
+      dataset = get_week_keys(week_partitions)
+    else:
+      dataset = load_dataset(columns=columns, low_memory=LOW_MEMORY)
+
+  # (run_scenarios.py computes a whole matrix of these scenarios at once, sharing loading, partitioning and alignments,
+  # period_analysis.py aggregates the results of a run over any periods, without aligning again, and deviation_index.py
+  # queries the planned operations that were skipped, moved or added)
+  # for period, name in zip(['COVID', 'POST_COVID'], ['covid', 'post_covid']):
+  for urgency_types_to_consider, name in zip([['Elezione'], ['Elezione', 'Urgenza', 'Emergenza']], ['e', 'eue']):
+  # for should_consider_reserves, name in zip([True, False], ['reserves', 'noreserves']):
+    print(f'Considering case "{name}"...')
+    set_labels(scenario=name)
+
+    # Compute alignments
+    with stage('compute_alignment'):
+      _, changed = compute_alignment(
+        dataset=dataset,
+        output_path=run_output_path,
+        output_filename=f'results_{name}.json',
+        urgency_types_to_consider=urgency_types_to_consider,
+        should_consider_reserves=False,
+        should_save_petri_nets=True,
+        petri_nets_format=PETRI_NETS_FORMAT,
+        petri_nets_store_path=PETRI_NETS_STORE_PATH,
+        n_workers=ALIGNMENT_N_WORKERS,
+        chunk_size=ALIGNMENT_CHUNK_SIZE,
+        cache_path=ALIGNMENT_CACHE_PATH,
+        cache_max_size=ALIGNMENT_CACHE_MAX_SIZE,
+        engine=ALIGNMENT_ENGINE,
+        incremental=incremental,
+        results_store_path=os.path.join(run_output_path, 'results.sqlite'),
+        scenario=name,
+        max_time=ALIGNMENT_MAX_TIME,
+        max_states=ALIGNMENT_MAX_STATES,
+        low_memory=LOW_MEMORY,
+        should_index_deviations=DEVIATION_INDEX,
+        week_partitions=week_partitions,
+      )
+
+    # Compute average fitness by department
+    with stage('compute_average_fitness_by_year_week'):
+      compute_average_fitness_by_year_week(
+        dataset=dataset,
+        output_path=run_output_path,
+        output_filename=f'average_fitness_by_year_week_{name}.json',
+        input_filename=f'results_{name}.json',
+        results_store_path=os.path.join(run_output_path, 'results.sqlite'),
+        scenario=name,
+        changed_year_week_departments=changed if incremental else None,
+      )
+
+  set_labels()
+
+  # Plot average fitness by department
+  with stage('plot_average_fitness_by_year_week'):
+    plot_average_fitness_by_year_week(
+      dataset=dataset,
+      output_path=run_output_path,
+      input_filenames=[
+        'average_fitness_by_year_week_e.json',
+        'average_fitness_by_year_week_eue.json',
+      ]
+    )
+
+  # Save timings and memory usage of every stage, and print the slowest weeks
+  write_run_report(run_output_path)
+
+# The guard is needed because worker processes (see ALIGNMENT_N_WORKERS) may re-import this module
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,294 @@
+import os
+import json
+import argparse
+import itertools
+from datetime import datetime
+from contextlib import ExitStack
+import pandas as pd
+
+from config import *
+from load_dataset import load_dataset
+from instrumentation import stage, write_run_report
+from compute_alignment import cast_df, partition_dataset, compute_week_fingerprint, build_petri_net_for_week, run_alignment_jobs, new_alignment_plan, plan_week, store_job_result, report_alignment_results
+from petri_net_export import petri_net_exporter, can_export_petri_nets
+from results_store import open_results_store, get_stored_results, set_stored_year_week_departments, delete_results
+from analyze_alignment_results import compute_average_fitness_by_year_week, plot_average_fitness_by_year_week
+
+# Scenario matrix runner: computes every combination of SCENARIO_URGENCY_TYPES x SCENARIO_RESERVES x SCENARIO_PERIODS
+# The dataset is loaded, cast and partitioned once, the weeks with the same variant in any scenario (same planned day
+# structure and actual sequence, same reserves setting, see compute_week_variant) are aligned once, and all the
+# alignments run in a single worker pool, so a sweep takes about the time of its largest scenario instead of the sum of
+# all of them
+
+def get_scenarios(urgency_types=SCENARIO_URGENCY_TYPES, reserves=SCENARIO_RESERVES, periods=SCENARIO_PERIODS):
+  dimensions = [urgency_types, reserves, periods]
+  scenarios = {}
+
+  for keys in itertools.product(*dimensions):
+    name = '_'.join(key for key, dimension in zip(keys, dimensions) if len(dimension) > 1) or '_'.join(keys)
+
+    scenarios[name] = {
+      'urgency_types_to_consider': urgency_types[keys[0]],
+      'should_consider_reserves': reserves[keys[1]],
+      'period': periods[keys[2]],
+    }
+
+  return scenarios
+
+# A week belongs to a period if its first operation (planned or actual, of any urgency type) is within it
+def get_week_first_dates(dataset):
+  dates = pd.to_datetime(dataset[TIMESTAMP_KEY], format='%d/%m/%Y')
+
+  return dates.groupby(dataset[YEAR_WEEK_DEPARTMENT_KEY], sort=False, observed=True).min().to_dict()
+
+def is_week_in_period(first_date, period):
+  start, end = period
+
+  return (start == None or first_date >= pd.Timestamp(start)) and (end == None or first_date <= pd.Timestamp(end))
+
+def filter_urgency_types(frame, urgency_types_to_consider):
+  return frame[frame[URGENCY_TYPE_KEY].isin(urgency_types_to_consider)]
+
+# Returns { scenario: results } (same results as compute_alignment for each scenario) and { scenario: year_week_departments
+# of its period }; results are also saved as results_<scenario>.json and, all together, as results_scenarios.json
+# Results are streamed to the results store (if any) as soon as each week is aligned: with resume=True the weeks already
+# in the store (with the same fingerprint and an exact fitness) are not aligned again
+def run_scenarios(
+  dataset,
+  scenarios,
+  output_path='output',
+  should_save_petri_nets=False,
+  petri_nets_format='svg',
+  petri_nets_store_path=PETRI_NETS_STORE_PATH,
+  n_workers=1,
+  chunk_size=1,
+  cache_path=None,
+  cache_max_size=None,
+  engine='pm4py',
+  results_store_path=None,
+  resume=False,
+  max_time=None,
+  max_states=None,
+  should_index_deviations=False,
+):
+  print(f'Computing alignments of {len(scenarios)} scenarios...')
+
+  results_store = None
+  if results_store_path is not None:
+    results_store = open_results_store(results_store_path)
+
+  # the moves of the alignments are indexed in the results store (see deviation_index.py)
+  should_index_deviations = should_index_deviations and results_store is not None
+
+  week_first_dates = get_week_first_dates(dataset)
+
+  urgency_types = set(
+    urgency_type for scenario in scenarios.values() for urgency_type in scenario['urgency_types_to_consider']
+  )
+  dataset = filter_urgency_types(dataset, urgency_types)
+
+  # cast and partition once for all the scenarios, each scenario only filters the partitions of its weeks
+  with stage('cast_df'):
+    cast_dataset = cast_df(dataset)
+
+  with stage('partition_dataset'):
+    partitions = partition_dataset(cast_dataset)
+
+  petri_nets_path = None
+  if should_save_petri_nets and can_export_petri_nets(petri_nets_format):
+    petri_nets_path = os.path.join(output_path, 'petri_nets')
+    for name in scenarios:
+      os.makedirs(os.path.join(petri_nets_path, name), exist_ok=True)
+
+  # distinct alignment jobs of all the scenarios (see new_alignment_plan), and for each scenario its (year_week_department,
+  # fingerprint, job index or None if its result is already stored) in the same order as compute_alignment
+  # the operations of each (year_week_department, fingerprint) are kept to build its petri net and date its moves
+  plan = new_alignment_plan()
+  week_partitions = {}
+  scenario_jobs = {}
+  stored_results_by_scenario = {}
+  year_week_departments_by_scenario = {}
+
+  with stage('plan_scenarios'):
+    for name, scenario in scenarios.items():
+      should_consider_reserves = scenario['should_consider_reserves']
+
+      # rows without a Year_Week_Reparto belong to no week, as in compute_alignment
+      year_week_department_list = filter_urgency_types(dataset, scenario['urgency_types_to_consider'])[YEAR_WEEK_DEPARTMENT_KEY].dropna().unique().tolist()
+      year_week_departments_by_scenario[name] = [
+        year_week_department for year_week_department, first_date in week_first_dates.items()
+        if is_week_in_period(first_date, scenario['period'])
+      ]
+      period_year_week_departments = set(year_week_departments_by_scenario[name])
+
+      scenario_jobs[name] = []
+
+      stored_results_by_scenario[name] = {}
+      if results_store is not None:
+        if resume:
+          stored_results_by_scenario[name] = get_stored_results(results_store, name)
+        else:
+          delete_results(results_store, name)
+
+      for year_week_department in year_week_department_list:
+        if year_week_department not in period_year_week_departments:
+          continue
+
+        prev, act = (filter_urgency_types(frame, scenario['urgency_types_to_consider']) for frame in partitions[year_week_department])
+
+        fingerprint = compute_week_fingerprint(prev, act, should_consider_reserves)
+
+        week = (name, year_week_department, len(scenario_jobs[name]), fingerprint)
+        job_idx = plan_week(plan, week, prev, act, should_consider_reserves, stored_results_by_scenario[name].get(year_week_department))
+        if job_idx is not None:
+          week_partitions[(year_week_department, fingerprint)] = (prev, act, should_consider_reserves)
+
+        scenario_jobs[name].append((year_week_department, fingerprint, job_idx))
+
+  # each job aligns the first week of its variant
+  job_weeks = plan['job_weeks']
+  first_weeks = [(weeks[0][1], weeks[0][3]) for weeks in job_weeks]
+  jobs = [
+    (week[0], *week_partitions[week], cache_path, engine, None, max_time, max_states, should_index_deviations)
+    for week in first_weeks
+  ]
+
+  print(
+    f'{sum(len(weeks) for weeks in scenario_jobs.values())} weeks in all the scenarios, {len(week_partitions)} distinct weeks, '
+    f'{len(jobs)} distinct alignments (dedup ratio {len(week_partitions) / max(len(jobs), 1):.2f})'
+  )
+
+  # each distinct net is built once, here only if it has to be saved or aligned with pm4py (then only for the first
+  # week of each variant)
+  petri_nets = {}
+  if petri_nets_path is not None or engine != 'day_sequence':
+    with stage('build_petri_nets'):
+      petri_nets = {
+        week: build_petri_net_for_week(week_partitions[week][0], week[0], week_partitions[week][2])
+        for week in (week_partitions if petri_nets_path is not None else first_weeks)
+      }
+
+    # the day_sequence engine doesn't need the nets, so they aren't sent to the workers
+    if engine != 'day_sequence':
+      jobs = [(*job[:6], petri_nets[week], *job[7:]) for job, week in zip(jobs, first_weeks)]
+
+  with stage('align_weeks', weeks=len(week_partitions), alignments=len(jobs)), ExitStack() as exit_stack:
+    export_petri_net = None
+    if petri_nets_path is not None:
+      export_petri_net = exit_stack.enter_context(petri_net_exporter(petri_nets_store_path, format=petri_nets_format))
+
+    def on_result(job_idx, alignment_result):
+      store_job_result(
+        results_store, job_weeks[job_idx], alignment_result, should_index_deviations,
+        lambda week: week_partitions[(week[1], week[3])][:2]
+      )
+
+      # the petri net of each week is exported once per scenario
+      for name, year_week_department, _, fingerprint in job_weeks[job_idx]:
+        petri_net = petri_nets.get((year_week_department, fingerprint))
+        if export_petri_net is not None and petri_net[0] is not None:
+          export_petri_net(
+            *petri_net,
+            os.path.join(petri_nets_path, name, f'{year_week_department}-{scenarios[name]["should_consider_reserves"]}')
+          )
+
+    alignment_results = run_alignment_jobs(jobs, n_workers=n_workers, chunk_size=chunk_size, on_result=on_result, engine=engine)
+
+  report_alignment_results(alignment_results, job_weeks, cache_path, cache_max_size)
+
+  # weeks without planned operations are skipped, as in compute_alignment
+  results_by_scenario = {}
+
+  for name, weeks in scenario_jobs.items():
+    results_by_scenario[name] = {}
+
+    for year_week_department, _, job_idx in weeks:
+      if job_idx is None:
+        alignment_res = stored_results_by_scenario[name][year_week_department][1]
+      else:
+        alignment_res = alignment_results[job_idx][0]
+
+      if alignment_res != None:
+        results_by_scenario[name][year_week_department] = alignment_res
+
+    with open(os.path.join(output_path, f'results_{name}.json'), 'w') as f:
+      json.dump(results_by_scenario[name], f, indent=2)
+
+  with open(os.path.join(output_path, 'results_scenarios.json'), 'w') as f:
+    json.dump(results_by_scenario, f, indent=2)
+
+  if results_store is not None:
+    for name, weeks in scenario_jobs.items():
+      set_stored_year_week_departments(results_store, name, [year_week_department for year_week_department, *_ in weeks])
+
+    results_store.close()
+
+  return results_by_scenario, year_week_departments_by_scenario
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Compute the alignments of all the scenarios of the scenario matrix (see config.py)')
+  parser.add_argument('--resume', default=None, help='output folder of an interrupted run to resume (only the weeks missing from its results store are aligned)')
+  args = parser.parse_args(argv)
+
+  # Create an output folder for this specific run (or reuse the one of the run to resume)
+  if args.resume is not None:
+    run_output_path = args.resume
+  else:
+    timestamp = datetime.now().strftime('%Y-%m-%d %H-%M-%S')
+    run_output_path = os.path.join(OUTPUT_PATH, f'scenarios {timestamp}')
+    os.makedirs(run_output_path)
+
+  # Load the dataset
+  with stage('load_dataset'):
+    dataset = load_dataset(columns=[YEAR_WEEK_DEPARTMENT_KEY, ACTIVITY_KEY, TIMESTAMP_KEY, SLICE_KEY, URGENCY_TYPE_KEY, RESERVE_KEY])
+
+  scenarios = get_scenarios()
+
+  # Compute alignments of all the scenarios
+  with stage('run_scenarios'):
+    results_by_scenario, year_week_departments_by_scenario = run_scenarios(
+      dataset=dataset,
+      scenarios=scenarios,
+      output_path=run_output_path,
+      should_save_petri_nets=True,
+      petri_nets_format=PETRI_NETS_FORMAT,
+      petri_nets_store_path=PETRI_NETS_STORE_PATH,
+      n_workers=ALIGNMENT_N_WORKERS,
+      chunk_size=ALIGNMENT_CHUNK_SIZE,
+      cache_path=ALIGNMENT_CACHE_PATH,
+      cache_max_size=ALIGNMENT_CACHE_MAX_SIZE,
+      engine=ALIGNMENT_ENGINE,
+      results_store_path=os.path.join(run_output_path, 'results.sqlite'),
+      resume=args.resume is not None,
+      max_time=ALIGNMENT_MAX_TIME,
+      max_states=ALIGNMENT_MAX_STATES,
+      should_index_deviations=DEVIATION_INDEX,
+    )
+
+  # Compute average fitness by year_week of each scenario (only the year_weeks of its period)
+  with stage('compute_average_fitness_by_year_week'):
+    for name in results_by_scenario:
+      print(f'Considering case "{name}"...')
+
+      compute_average_fitness_by_year_week(
+        dataset=dataset[dataset[YEAR_WEEK_DEPARTMENT_KEY].isin(year_week_departments_by_scenario[name])],
+        output_path=run_output_path,
+        output_filename=f'average_fitness_by_year_week_{name}.json',
+        results_store_path=os.path.join(run_output_path, 'results.sqlite'),
+        scenario=name,
+      )
+
+  # Plot average fitness by year_week of all the scenarios
+  with stage('plot_average_fitness_by_year_week'):
+    plot_average_fitness_by_year_week(
+      dataset=dataset,
+      output_path=run_output_path,
+      input_filenames=[f'average_fitness_by_year_week_{name}.json' for name in scenarios],
+    )
+
+  # Save timings and memory usage of every stage, and print the slowest weeks
+  write_run_report(run_output_path)
+
+# The guard is needed because worker processes (see ALIGNMENT_N_WORKERS) may re-import this module
+if __name__ == '__main__':
+  main()
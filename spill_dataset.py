@@ -0,0 +1,105 @@
+import os
+import json
+import pickle
+import shutil
+import pandas as pd
+
+from config import *
+from load_dataset import read_typed_csv_chunks, check_snapshot, write_snapshot_info
+
+# Out-of-core mode (see OUT_OF_CORE), for exports that don't fit in memory: the csv is read in chunks of
+# DATASET_CHUNK_SIZE rows and its rows are spilled into on-disk partitions, so that the pipelines load one partition at
+# a time and their peak memory is bounded by the largest partition instead of the whole export
+# - week partitions: one per Year_Week_Reparto, for the alignments (see index_spilled_week_partitions)
+# - month partitions: one per month of DATA, for the statistics of compute_statistics.py
+# The partitions of <csv name>.csv are kept in the folder <csv name>.<kind>_partitions and spilled again only when the
+# csv changes (see check_snapshot); each partition is a file of pickled frames (one per chunk it has rows in) with the
+# original row index, so that a loaded partition has the same rows, in the same order, as the loaded dataset
+# The manifest of the partitions (partitions.json) is a dict with
+# - path: folder of the partitions
+# - keys: partition keys in order of first appearance in the csv, partition i is the file <i>.pkl
+# - first_rows: for each partition, { urgency type: first row of the csv with it } (week partitions only)
+
+PARTITION_KINDS = ['week', 'month']
+
+def get_partitions_path(path, kind):
+  return f'{os.path.splitext(path)[0]}.{kind}_partitions'
+
+def _get_partition_keys(chunk, kind):
+  if kind == 'week':
+    return chunk[YEAR_WEEK_DEPARTMENT_KEY]
+
+  # operations without DATA still count in the room usage, they get their own partition
+  return chunk[TIMESTAMP_KEY].dt.strftime('%Y-%m').fillna('')
+
+# Spill the given columns of the dataset csv at path (only the rows of slice_val, all of them if None) into partitions
+# of the given kind, returns their manifest
+def spill_dataset(path=DATASET_PATH, kind='week', columns=DATASET_COLUMNS, slice_val=None, chunk_size=DATASET_CHUNK_SIZE):
+  assert kind in PARTITION_KINDS, f'unknown partition kind {kind}'
+
+  partitions_path = get_partitions_path(path, kind)
+  manifest_path = os.path.join(partitions_path, 'partitions.json')
+
+  # the partitions are valid if they were spilled from the current csv with the same columns and slice
+  is_valid, partitions_info = check_snapshot(path, partitions_path, { 'columns': columns, 'slice': slice_val })
+
+  # the manifest is written last, a missing manifest means an interrupted spill
+  if is_valid and os.path.exists(manifest_path):
+    with open(manifest_path) as f:
+      return json.load(f)
+
+  print(f'Spilling {path} into {kind} partitions...')
+
+  shutil.rmtree(partitions_path, ignore_errors=True)
+  os.makedirs(partitions_path)
+
+  partition_idxs = {}
+  first_rows = []
+
+  for chunk in read_typed_csv_chunks(path, columns, DATASET_DATE_COLUMNS, DATASET_DECIMAL_COLUMNS, chunk_size):
+    if slice_val is not None:
+      chunk = chunk[chunk[SLICE_KEY] == slice_val]
+
+    # rows without a Year_Week_Reparto are left out, as groupby does
+    for key, group in chunk.groupby(_get_partition_keys(chunk, kind), sort=False):
+      if key not in partition_idxs:
+        partition_idxs[key] = len(partition_idxs)
+        first_rows.append({})
+
+      partition_idx = partition_idxs[key]
+
+      with open(os.path.join(partitions_path, f'{partition_idx}.pkl'), 'ab') as f:
+        pickle.dump(group, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+      # the index of the chunks is the row number in the csv, so the first row of each urgency type is its index
+      if kind == 'week':
+        urgency_types = group[URGENCY_TYPE_KEY].drop_duplicates()
+        for urgency_type, row in zip(urgency_types.astype(str).tolist(), urgency_types.index.tolist()):
+          first_rows[partition_idx].setdefault(urgency_type, row)
+
+  partitions = { 'path': partitions_path, 'keys': list(partition_idxs), 'first_rows': first_rows }
+
+  with open(manifest_path, 'w') as f:
+    json.dump(partitions, f)
+
+  write_snapshot_info(path, partitions_path, partitions_info)
+
+  return partitions
+
+# Rows of partition partition_idx, as a single frame
+def load_partition(partitions, partition_idx):
+  frames = []
+
+  with open(os.path.join(partitions['path'], f'{partition_idx}.pkl'), 'rb') as f:
+    while True:
+      try:
+        frames.append(pickle.load(f))
+      except EOFError:
+        break
+
+  return frames[0] if len(frames) == 1 else pd.concat(frames)
+
+# Partition keys of week partitions as a dataset with only the Year_Week_Reparto column, for the analyses that just
+# need the weeks of the dataset (e.g. compute_average_fitness_by_year_week)
+def get_week_keys(partitions):
+  return pd.DataFrame({ YEAR_WEEK_DEPARTMENT_KEY: partitions['keys'] })
@@ -0,0 +1,41 @@
+import sys
+import importlib
+import multiprocessing
+
+from config import *
+
+# Start of the worker processes of the pipelines (alignment jobs, plot rendering), see WORKER_START_METHOD
+# With 'forkserver' every worker is forked from a server process that has already imported the main module and the
+# given modules: workers start without importing pandas (and pm4py or matplotlib, if preloaded) again, as they would
+# with 'spawn', and without inheriting the memory (e.g. the whole dataset) and the threads (e.g. the petri net
+# exporter) of the main process, as they would with 'fork'
+# The server is started once per process, with the modules preloaded by the first pool that uses it
+
+# Modules imported by the workers of the A* alignments, preloaded when the engine may need them
+PM4PY_WORKER_MODULES = [
+  'pm4py.objects.petri_net.obj',
+  'pm4py.objects.log.obj',
+  'pm4py.algo.conformance.alignments.petri_net.algorithm',
+  'pm4py.algo.evaluation.replay_fitness.variants.alignment_based',
+]
+
+# Multiprocessing context of the worker pools, None for the default one (start_method is None or not available on this
+# platform, e.g. forkserver on Windows)
+def get_worker_context(preload_modules=[], start_method=WORKER_START_METHOD):
+  if start_method is None or start_method not in multiprocessing.get_all_start_methods():
+    return None
+
+  context = multiprocessing.get_context(start_method)
+
+  # the main module is preloaded only if it is a script (not an interactive session), which has to run its pipeline under
+  # an if __name__ == '__main__' guard, as with 'spawn'
+  if start_method == 'forkserver':
+    main_modules = ['__main__'] if getattr(sys.modules.get('__main__'), '__file__', None) else []
+    context.set_forkserver_preload([*main_modules, *preload_modules])
+
+  return context
+
+# Import the modules that get_worker_context preloads in the workers, for the jobs run in this process (serial runs)
+def import_modules(modules):
+  for module in modules:
+    importlib.import_module(module)